@@ -10,17 +10,217 @@ methods that can act on colletions of images.
 """
 
 from iptcinfo import IPTCInfo
+import array
+import binascii
+import bisect
+import collections
+import ctypes
+import ctypes.util
+import datetime
+import errno
+import fcntl
+import glob
+import hashlib
 import itertools
+import json
 import logging
+import mmap
+import multiprocessing.pool
 import os.path
+import pickle
 import re
+import select
+import shutil
+import socket
+import sqlite3
+import struct
+import tempfile
+import threading
+import time
 import uuid
+import weakref
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
 
 __docformat__ = "restructuredtext en"
 
 next_id = 1
+
+change_listeners = []
+"""
+Functions that are called with the old path and the :py:class:`Image` after
+the file of the image has been renamed or its IPTC fields have been written.
+"""
+
+_filename_pattern = re.compile(r"([^#]+)(#.*)*\.(\w+)")
+_suffix_pattern = re.compile(r"\w+\Z")
+_number_pattern = re.compile(r"\d+")
+_folder_pattern = re.compile(r"([012]\d{3}[01]\d[0123]\d)-([^/]+)/?")
+_date_pattern = re.compile(r"([012]\d{3}[01]\d[0123]\d)-")
+_exif_date_pattern = re.compile(r"([012]\d{3}):([01]\d):([0123]\d)[ T]")
+
+date_sources = ['folder', 'filename', 'exif']
+"""
+Where :py:class:`Image` takes the date from first. The folder name is the
+default, the date in the filename is used if there is no dated folder.
+"""
+
+cache_dir = os.path.expanduser('~/.cache/picture-db-scripts')
+"""
+Directory where caches and indices are stored.
+"""
 logging.basicConfig(level=logging.FATAL)
 
+class _Timer(object):
+    __slots__ = ['stats', 'name', 'start']
+
+    def __init__(self, stats, name):
+        self.stats = stats
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+
+    def __exit__(self, type, value, traceback):
+        self.stats.add_time(self.name, time.time() - self.start)
+
+class _NoTimer(object):
+    def __enter__(self):
+        pass
+
+    def __exit__(self, type, value, traceback):
+        pass
+
+_no_timer = _NoTimer()
+
+class Stats(object):
+    """
+    Counters and timers of the work that has been done.
+
+    Nothing is recorded unless :py:attr:`enabled` is set. The timers add up
+    the time spent in all threads, so they can exceed the wall time.
+
+    >>> stats = Stats()
+    >>> stats.enabled = True
+    >>> stats.count('renames', 2)
+    >>> with stats.timer('rename'):
+    ...     pass
+    >>> stats.as_dict()['counters']
+    {'renames': 2}
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.counters = collections.Counter()
+        self.timers = collections.Counter()
+
+    def count(self, name, amount=1):
+        """
+        Increases a counter.
+
+        :param name: Name of the counter.
+        :param amount: Value to add.
+        :type amount: int
+        """
+        if self.enabled:
+            with self.lock:
+                self.counters[name] += amount
+
+    def add_time(self, name, seconds):
+        """
+        Adds to a timer.
+
+        :param name: Name of the timer.
+        :param seconds: Time to add.
+        :type seconds: float
+        """
+        if self.enabled:
+            with self.lock:
+                self.timers[name] += seconds
+
+    def timer(self, name):
+        """
+        Gives a context manager that adds the time spent in it to a timer.
+
+        :param name: Name of the timer.
+        """
+        if self.enabled:
+            return _Timer(self, name)
+        return _no_timer
+
+    def merge(self, data):
+        """
+        Adds counters and timers from :py:meth:`as_dict`, for example from
+        another process.
+
+        :param data: Counters and timers.
+        :type data: dict
+        """
+        with self.lock:
+            self.counters.update(data['counters'])
+            self.timers.update(data['timers'])
+
+    def reset(self):
+        """
+        Sets all counters and timers back to zero.
+        """
+        with self.lock:
+            self.counters.clear()
+            self.timers.clear()
+
+    def as_dict(self):
+        """
+        Gives the counters and timers in a form that can be dumped as JSON.
+
+        :rtype: dict
+        """
+        with self.lock:
+            return {'counters': dict(self.counters), 'timers': dict(self.timers)}
+
+    def summary(self):
+        """
+        Formats the counters and timers as a table.
+
+        :rtype: str
+        """
+        lines = []
+        with self.lock:
+            for name, value in sorted(self.counters.items()):
+                lines.append('{:24} {:12d}'.format(name, value))
+            for name, seconds in sorted(self.timers.items()):
+                lines.append('{:24} {:12.3f} s'.format(name, seconds))
+        return '\n'.join(lines)
+
+stats = Stats()
+"""
+Instrumentation of this module, enabled by ``hashtag --stats``.
+"""
+
+def _counted_stat(function):
+    """
+    Wraps a function of :py:mod:`os.path` that stats a file, such that every
+    call is counted as ``stat calls`` in :py:data:`stats`.
+    """
+    def wrapper(path):
+        stats.count('stat calls')
+        return function(path)
+    wrapper.__name__ = function.__name__
+    return wrapper
+
+_isfile = _counted_stat(os.path.isfile)
+_isdir = _counted_stat(os.path.isdir)
+_islink = _counted_stat(os.path.islink)
+_exists = _counted_stat(os.path.exists)
+_lexists = _counted_stat(os.path.lexists)
+_stat = _counted_stat(os.stat)
+
 class Tag(object):
     """
     Models a tag.
@@ -28,6 +228,19 @@ class Tag(object):
     To make the tag filename safe, it does the following:
 
     - Space with ``_``
+
+    Tags are interned, creating a tag with the same text twice gives the very
+    same object:
+
+    >>> Tag('Martin Ueding') is Tag.from_escaped('Martin_Ueding')
+    True
+    """
+
+    __slots__ = ['text', '__weakref__']
+
+    _registry = weakref.WeakValueDictionary()
+    """
+    All tags that are currently alive, by their text.
     """
 
     replacements = [
@@ -37,6 +250,23 @@ class Tag(object):
     List with replacements to make them filename safe.
     """
 
+    _escaped = {}
+    """
+    Memoized results of :py:meth:`escape`.
+    """
+
+    _unescaped = {}
+    """
+    Memoized results of :py:meth:`from_escaped`.
+    """
+
+    def __new__(cls, text):
+        tag = cls._registry.get(text)
+        if tag is None:
+            tag = super(Tag, cls).__new__(cls)
+            cls._registry[text] = tag
+        return tag
+
     def __init__(self, text):
         """
         Creates a new Tag from human readable text.
@@ -45,6 +275,9 @@ class Tag(object):
         """
         self.text = text
 
+    def __getnewargs__(self):
+        return (self.text,)
+
     @staticmethod
     def from_escaped(escaped):
         """
@@ -53,9 +286,14 @@ class Tag(object):
         :param escaped: Escaped text.
         :return: Unescaped text.
         """
-        unescaped = re.sub(r"_", " ", escaped)
-        for replace, pattern in Tag.replacements:
-            unescaped = re.sub(pattern, replace, unescaped)
+        try:
+            unescaped = Tag._unescaped[escaped]
+        except KeyError:
+            unescaped = escaped
+            for replace, pattern in Tag.replacements:
+                unescaped = unescaped.replace(pattern, replace)
+            Tag._unescaped[escaped] = unescaped
+
         return Tag(unescaped)
 
     def escape(self):
@@ -64,10 +302,14 @@ class Tag(object):
 
         :return: Escaped string.
         """
-        escaped = self.text
-        for pattern, replace in self.replacements:
-            escaped = re.sub(pattern, replace, escaped)
-        return escaped
+        try:
+            return Tag._escaped[self.text]
+        except KeyError:
+            escaped = self.text
+            for pattern, replace in self.replacements:
+                escaped = escaped.replace(pattern, replace)
+            Tag._escaped[self.text] = escaped
+            return escaped
 
     def __str__(self):
         return self.text
@@ -87,8 +329,47 @@ class Tag(object):
 class Image(object):
     """
     Models an image filename with tags.
+
+    The result of :py:meth:`current_path` is cached together with the
+    attributes it was computed from. It is only formatted again once the
+    date, event, number, suffix, directory or tags change.
+
+    Images only keep the IPTC keywords, not the whole IPTC record. The record
+    is read again when it gets written.
     """
-    def __init__(self, filename):
+
+    __slots__ = [
+        'basename', 'date', 'dirname', 'event', 'number', 'origname', 'prefix',
+        'suffix', 'keywords', 'index', 'tags',
+        '_index_keywords', '_tags_version', '_path', '_path_key',
+    ]
+
+    def __init__(self, filename, index=None, date_source='folder'):
+        """
+        Creates a new Image from the given filename.
+
+        Only the path is parsed here, the IPTC data is loaded lazily by
+        :py:meth:`load_iptc` once it is needed. If an index is given and it has
+        an up-to-date entry for the file, the image is hydrated from that entry
+        and the file is not parsed again.
+
+        The date is taken from the folder name by default. With the
+        ``filename`` source, a date at the start of the filename is preferred.
+        With ``exif``, the date the picture was taken is read from the Exif
+        data, if there is one, and a folder without a date is taken as the
+        event. The index only holds dates from the default
+        source, so it is not used with the others.
+
+        :param filename: Path to the image.
+        :param index: Metadata index to use.
+        :type index: MetadataIndex
+        :param date_source: One of :py:data:`date_sources`.
+        """
+        if date_source not in date_sources:
+            raise ValueError('Unknown date source “{}”.'.format(date_source))
+        if date_source != 'folder':
+            index = None
+
         logging.info('Creating new Image from “{}”.'.format(filename))
 
         self.basename = ""
@@ -99,18 +380,37 @@ class Image(object):
         self.origname = ""
         self.prefix = ""
         self.suffix = ""
-        self.iptc = None
+        self.keywords = None
+        self.index = index
+        self._index_keywords = None
 
         self.tags = set()
+        self._tags_version = 0
+        self._path = None
+        self._path_key = None
 
         self.origname = filename
         self.dirname = os.path.dirname(filename)
         self.basename = os.path.basename(filename)
 
-        self._parse_folder_name()
-        self._parse_filename()
-
-        self._load_iptc()
+        entry = None
+        if index is not None:
+            entry = index.lookup(filename)
+
+        if entry is None:
+            self._parse_folder_name(date_source == 'exif')
+            if date_source == 'exif':
+                self._parse_exif_date()
+            self._parse_filename()
+            if date_source == 'filename':
+                m = _date_pattern.match(self.prefix)
+                if m is not None and _is_date(m.group(1)):
+                    self.date = m.group(1)
+
+            if index is not None:
+                index.store(filename, self, self.get_tags(), None)
+        else:
+            self._hydrate(entry)
 
     def add_tag(self, tag):
         """
@@ -124,6 +424,7 @@ class Image(object):
             raise TypeError("Image::add_tag(hashtags.Tag)")
 
         self.tags.add(tag)
+        self._tags_version += 1
 
     def remove_tag(self, tag):
         """
@@ -138,40 +439,80 @@ class Image(object):
             raise TypeError("Image::remove_tag(hashtags.Tag)")
 
         self.tags.discard(tag)
+        self._tags_version += 1
 
     def __repr__(self):
         return "Image('{}')".format(self.current_path())
 
-    def rename(self):
+    def rename(self, policy='bump', listings=None):
         """
         Performs the actual renaming.
 
-        If the file exists, it will try to increase the picture number. If the
-        attribute :py:attr:`tempname` is set, this name will be used instead of
-        :py:attr:`origname`.
+        If the file exists, the collision is resolved with
+        :py:func:`plan_renames`.
+
+        Without ``listings``, only the names the image can take are looked
+        up, one stat call each, up to the first free one. When the images of a
+        directory are renamed one by one, the same ``listings`` can be passed
+        every time instead. The directory is then listed once, which costs
+        O(n) for n files, and the listing is kept up to date with each
+        rename.
+
+        :param policy: One of :py:data:`collision_policies`.
+        :param listings: Snapshot of the directories for
+            :py:func:`plan_renames`.
+        :type listings: dict
         """
+        snapshot = listings
+        if snapshot is None:
+            snapshot = self._candidate_listing()
+
+        if len(plan_renames([self], snapshot, policy)) == 0:
+            return
+
         newname = self.current_path()
-        if os.path.isfile(newname):
-            print 'File “{}” already exists.'.format(newname)
-            answer = raw_input('Do you want to increase the number? [Y/n] ')
 
-            if answer != "n":
-                while os.path.isfile(newname):
-                    self.number = str(int(self.number) +1)
-                    newname = self.current_path()
+        logging.info('Renaming “{}” to “{}”.'.format(self.origname, newname))
+        os.rename(self.origname, newname)
 
-            print 'Now using “{}”.'.format(newname)
+        if listings is not None:
+            names = listings[self.dirname]
+            names.discard(self.basename)
+            names.add(os.path.basename(newname))
 
-        assert not os.path.isfile(newname)
+        self._set_origname(newname)
 
-        oldname = self.origname
+    def _candidate_listing(self):
+        """
+        Gives a snapshot for :py:func:`plan_renames` that only contains the
+        names this image would be bumped through, up to the first free one.
+
+        :rtype: dict
+        """
+        names = set([self.basename])
+        number = self.number
         try:
-            oldname = self.tempname
-        except AttributeError:
-            pass
+            while True:
+                candidate = os.path.basename(self.current_path())
+                if candidate == self.basename or not _lexists(os.path.join(self.dirname, candidate)):
+                    break
+                names.add(candidate)
+                self.number = _bump_number(self.number)
+        finally:
+            self.number = number
+
+        return {self.dirname: names}
+
+    def _set_origname(self, newname):
+        """
+        Records that the file has been renamed.
 
-        logging.info('Renaming “{}” to “{}”.'.format(self.origname, newname))
-        os.rename(oldname, newname)
+        :param newname: Path the file has now.
+        """
+        oldname = self.origname
+        self.origname = newname
+        self.basename = os.path.basename(newname)
+        self._changed(oldname, newname)
 
     def _tagstring(self):
         tagstring = ""
@@ -188,6 +529,11 @@ class Image(object):
         :return: Current path.
         :rtype: str
         """
+        key = (self.date, self.event, self.number, self.suffix, self.dirname,
+               self._tags_version)
+        if key == self._path_key:
+            return self._path
+
         filename = "{}-{}-{}{}.{}".format(
             self.date, self.event, self.number, self._tagstring(), self.suffix
         )
@@ -197,6 +543,8 @@ class Image(object):
         if len(pathname) > 256:
             raise FilenameTooLongError("Filename “{}” is longer than 256 chars.".format(pathname))
 
+        self._path = pathname
+        self._path_key = key
         return pathname
 
     def _parse_filename(self):
@@ -205,20 +553,15 @@ class Image(object):
 
         :raises FilenameParseError: Raised if name could not be parsed.
         """
-        m = re.match(r"([^#]+)(#.*)*\.(\w+)", self.basename)
-
-        if m is None:
-            raise FilenameParseError('Could not parse “{}”.'.format(self.basename))
-
-        if not m.group(2) is None:
-            taglist = m.group(2).split("#")
+        prefix, tagstring, suffix = _split_filename(self.basename)
 
-            for tag in taglist:
+        if tagstring is not None:
+            for tag in tagstring.split("#"):
                 if len(tag) > 0:
                     self.add_tag(Tag.from_escaped(tag))
 
-        self.prefix = m.group(1)
-        self.suffix = m.group(3)
+        self.prefix = prefix
+        self.suffix = suffix
 
         self._parse_prefix()
 
@@ -242,7 +585,7 @@ class Image(object):
         # The number could not be parsed yet, try to find a number. At this
         # point, any number is fine.
         if self.number == "":
-            numbers = re.findall(r"\d+", self.prefix)
+            numbers = _number_pattern.findall(self.prefix)
             if len(numbers) > 0:
                 self.number = numbers[-1]
 
@@ -259,55 +602,149 @@ class Image(object):
         if self.number == "":
             raise NumberParseError('Could not parse “{}”.'.format(self.prefix))
 
-    def _parse_folder_name(self):
+    def _parse_folder_name(self, undated=False):
         """
         Parses date and event name from a folder name.
 
         Sets :py:attr:`date` and :py:attr:`event`.
+
+        :param undated: Whether a folder without a date is the event.
+        :type undated: bool
         """
         if len(self.dirname) == 0:
             return
 
-        pattern = re.compile(r"([012]\d{3}[01]\d[0123]\d)-([^/]+)/?")
         album_dir = os.path.basename(self.dirname)
-        m = pattern.match(album_dir)
+        m = _folder_pattern.match(album_dir)
         if m is None:
+            if undated and len(album_dir) > 0:
+                self.event = album_dir
+                return
             raise FolderParseError('Could not parse “{}”.'.format(album_dir))
 
         self.date = m.group(1)
         self.event = m.group(2)
 
-    def get_tags(self):
+    def _parse_exif_date(self):
+        """
+        Sets :py:attr:`date` from the Exif data of the file, if it has one.
+        """
+        try:
+            date = read_exif_date(self.origname)
+        except (JPEGFormatError, IOError) as e:
+            logging.info('No Exif date in “{}”: {}'.format(self.origname, e))
+            return
+
+        if date is not None:
+            self.date = date
+
+    def get_tags(self, iptc=False):
         """
         Gives the list with all tags.
 
+        :param iptc: Whether the IPTC keywords should be merged in.
+        :type iptc: bool
         :return: A list with all tags.
         :rtype: list
         """
+        if iptc:
+            self.load_iptc()
+
         return list(self.tags)
 
+    def load_iptc(self):
+        """
+        Loads the IPTC keywords and adds them as tags.
+
+        The file is only read the first time this is called.
+        """
+        if self.keywords is None:
+            self._load_iptc()
+
     def _load_iptc(self):
         """
         Loads the IPTC data from the original file and saves them with
         :py:meth:`add_tag`.
         """
-        try:
-            self.iptc = IPTCInfo(self.origname, force=True)
-        except IOError as e:
-            pass
+        if self._index_keywords is not None:
+            self.keywords = self._index_keywords
         else:
-            logging.info('Found Tags “{}” in “{}”.'.format(
-                ', '.join(sorted(self.iptc.keywords)), self.origname))
-            for keyword in self.iptc.keywords:
-                self.add_tag(Tag(keyword))
+            try:
+                self.keywords = self._read_keywords()
+            except IOError as e:
+                self.keywords = []
+                return
+
+            if self.index is not None:
+                self.index.store_keywords(self.origname, self.keywords)
+
+        logging.info('Found Tags “{}” in “{}”.'.format(
+            ', '.join(sorted(self.keywords)), self.origname))
+        for keyword in self.keywords:
+            self.add_tag(Tag(keyword))
+
+    def _read_keywords(self):
+        """
+        Reads the IPTC keywords from the file.
+
+        The header-only reader is used for JPEG files, everything it cannot
+        handle goes through ``iptcinfo``.
+
+        :return: Keywords.
+        :rtype: list
+        """
+        stats.count('iptc parses')
+        with stats.timer('iptc read'):
+            try:
+                return read_iptc_keywords(self.origname)
+            except JPEGFormatError as e:
+                logging.info('Using iptcinfo for “{}”: {}'.format(self.origname, e))
+                stats.count('iptcinfo parses')
+                return list(IPTCInfo(self.origname, force=True).keywords)
+
+    def _hydrate(self, entry):
+        """
+        Sets the parsed attributes from an index entry.
+
+        :param entry: Up-to-date entry from the index.
+        :type entry: IndexEntry
+        """
+        self.date = entry.date
+        self.event = entry.event
+        self.number = entry.number
+        self.suffix = entry.suffix
+        self._index_keywords = entry.keywords
+
+        for text in entry.tags:
+            self.add_tag(Tag(text))
+
+    def _changed(self, oldname, newname):
+        """
+        Replaces the index entry of the file after it has been changed and
+        notifies the :py:data:`change_listeners`.
+
+        :param oldname: Path the file had before.
+        :param newname: Path the file has now.
+        """
+        if self.index is not None:
+            self.index.discard(oldname)
+            self.index.store(newname, self, self.get_tags(), self.keywords)
+
+        for listener in change_listeners:
+            listener(oldname, self)
 
     def write_iptc(self):
         """
         Writes the IPTC data.
         """
-        self.iptc.data['keywords'] = list(sorted(self.get_tags()))
-        logging.info('Saving IPTC keywords to “{}”.'.format(self.origname))
-        self.iptc.save()
+        self.load_iptc()
+
+        keywords = [str(tag) for tag in sorted(self.get_tags())]
+
+        save_keywords(self.origname, keywords)
+
+        self.keywords = keywords
+        self._changed(self.origname, self.origname)
 
     def name_changed(self):
         """
@@ -326,108 +763,3002 @@ class Image(object):
         :return: Whether the IPTC tags need to be rewritten.
         :rtype: bool
         """
-        return sorted(map(Tag, self.iptc.keywords)) != sorted(self.get_tags())
+        self.load_iptc()
 
-    def save(self):
+        return sorted(map(Tag, self.keywords)) != sorted(self.get_tags())
+
+    def save(self, policy='bump', listings=None):
         """
         Renames the file and updates the IPTC fields.
+
+        :param policy: One of :py:data:`collision_policies`.
+        :param listings: Snapshot of the directories, see :py:meth:`rename`
+            for what it costs without one.
+        :type listings: dict
         """
         if self.iptc_changed():
             self.write_iptc()
 
         if self.name_changed():
-            self.rename()
+            self.rename(policy, listings)
 
-    def rename_to_temp(self):
-        """
-        Renames the image to a temporary name.
+def _is_date(text):
+    """
+    Checks whether the text is a date like ``20120204`` that exists.
 
-        It generates a random UUID 4 and renames the picture to it. The
-        temporary name is stored in the :py:attr:`tempname` attribute.
-        """
-        self.tempname = str(uuid.uuid4())
-        os.rename(self.origname, self.tempname)
+    >>> _is_date('20120229'), _is_date('20121339'), _is_date('00000000')
+    (True, False, False)
 
-class PictureDBError(Exception):
-    """
-    Exception class for this module.
+    :param text: Date with eight digits.
+    :rtype: bool
     """
-    pass
+    try:
+        datetime.datetime.strptime(text, '%Y%m%d')
+    except ValueError:
+        return False
+    return True
 
-class PictureParseError(PictureDBError):
-    """
-    General exception class for parsing the information in the file names.
+def _split_filename(basename):
     """
-    pass
+    Splits a filename into prefix, hashtags and suffix.
 
-class FilenameParseError(PictureParseError):
-    pass
+    Names like ``prefix#Tag_1#Tag_2.suffix`` are split with string operations
+    only, anything else goes through the full regular expression.
 
-class FolderParseError(PictureParseError):
-    pass
+    >>> _split_filename('20120204-Klopapierberg-9240#Martin_Ueding.jpg')
+    ('20120204-Klopapierberg-9240', '#Martin_Ueding', 'jpg')
+    >>> _split_filename('IMG_3523.jpg')
+    ('IMG_3523', None, 'jpg')
 
-class PrefixParseError(FilenameParseError):
-    pass
+    :param basename: Filename without directory.
+    :raises FilenameParseError: Raised if name could not be parsed.
+    :return: Tuple with prefix, the hashtags including the leading ``#`` or
+        ``None`` and the suffix.
+    :rtype: tuple
+    """
+    stem, dot, suffix = basename.rpartition('.')
+    if len(dot) > 0 and _suffix_pattern.match(suffix) is not None:
+        prefix, hash_, tagstring = stem.partition('#')
+        if len(prefix) > 0:
+            if len(hash_) == 0:
+                return prefix, None, suffix
+            return prefix, hash_ + tagstring, suffix
 
-class NumberParseError(PrefixParseError):
-    pass
+    m = _filename_pattern.match(basename)
 
-class EventParseError(PrefixParseError, FolderParseError):
-    """
-    Error related to the parsing of the event from either folder or image.
-    """
-    pass
+    if m is None:
+        raise FilenameParseError('Could not parse “{}”.'.format(basename))
 
-class DateParseError(PrefixParseError, FolderParseError):
+    return m.group(1), m.group(2), m.group(3)
+
+class TagTransaction(object):
     """
-    Error related to the parsing the date from either the folder or the image
-    file.
+    Collects tag edits on many images and applies them together.
+
+    Adding and removing tags is only recorded. Once the transaction is
+    applied, every image gets the net result of its edits. Images whose tags
+    end up the same as before are left alone, all others are written with a
+    single IPTC write and a single rename.
+
+    >>> transaction = TagTransaction()
+    >>> image = Image('20120204-Klopapierberg-1#Foo.jpg')
+    >>> transaction.add(image, Tag('Bar'))
+    >>> transaction.remove(image, Tag('Bar'))
+    >>> transaction.apply()
+    []
     """
-    pass
 
-class FilenameTooLongError(PictureDBError):
-    pass
+    def __init__(self, index=None):
+        """
+        Creates an empty transaction.
 
-def compress_numbers(images):
-    """
-    Compresses the numbers in the filenames.
+        :param index: Metadata index for images created from paths.
+        :type index: MetadataIndex
+        """
+        self.index = index
+        self.edits = collections.OrderedDict()
 
-    This has to be done to a whole collection so that they are numbered
-    correctly. The number of images are taken into account when padding the
-    number with leadings zeros.
+    def _record(self, image, tag, add):
+        if not isinstance(tag, Tag):
+            raise TypeError("TagTransaction needs a picturedb.Tag")
 
-    :param images: Images to rename.
-    :type images: list
+        if isinstance(image, Image):
+            path = image.origname
+        else:
+            path, image = image, None
+
+        if path not in self.edits:
+            self.edits[path] = (image, [])
+        self.edits[path][1].append((add, tag))
+
+    def add(self, image, tag):
+        """
+        Records that a tag is to be added.
+
+        :param image: Image or path to an image.
+        :param tag: Tag to add.
+        :type tag: Tag
+        """
+        self._record(image, tag, True)
+
+    def remove(self, image, tag):
+        """
+        Records that a tag is to be removed.
+
+        :param image: Image or path to an image.
+        :param tag: Tag to remove.
+        :type tag: Tag
+        """
+        self._record(image, tag, False)
+
+    def apply(self, jobs=1, iptc=True):
+        """
+        Applies the edits to the images in memory.
+
+        The IPTC keywords are loaded first such that the net change is
+        computed against all the tags the file has.
+
+        :param jobs: Number of threads to load the IPTC keywords with.
+        :type jobs: int
+        :param iptc: Whether to load the IPTC keywords.
+        :type iptc: bool
+        :return: Images whose tags changed.
+        :rtype: list
+        """
+        pending = []
+        for path, (image, edits) in self.edits.items():
+            if image is None:
+                image = Image(path, self.index)
+            pending.append((image, edits))
+
+        if iptc:
+            parallel_map(Image.load_iptc, [image for image, edits in pending], jobs)
+
+        changed = []
+        for image, edits in pending:
+            before = set(image.tags)
+            for add, tag in edits:
+                if add:
+                    image.add_tag(tag)
+                else:
+                    image.remove_tag(tag)
+
+            if image.tags != before:
+                changed.append(image)
+
+        self.edits.clear()
+        return changed
+
+    def commit(self, jobs=1, journal=None, policy='bump'):
+        """
+        Applies the edits and saves the images that changed.
+
+        :param jobs: Number of threads for the IPTC fields.
+        :type jobs: int
+        :param journal: Path of a journal for :py:func:`rename_files`.
+        :param policy: One of :py:data:`collision_policies`.
+        :return: Images that have been saved.
+        :rtype: list
+        """
+        changed = self.apply(jobs)
+        batch_save(changed, jobs, journal, policy)
+        return changed
+
+IndexEntry = collections.namedtuple(
+    'IndexEntry', ['date', 'event', 'number', 'suffix', 'tags', 'keywords'])
+"""
+Parsed metadata of a single file as it is stored in the
+:py:class:`MetadataIndex`.
+"""
+
+class MetadataIndex(object):
     """
-    image_count = len(images)
-    digit_count = len(str(image_count))
-    format_string = '{:0'+str(digit_count)+'d}'
+    Persistent index with the parsed metadata of the images.
 
-    for n, image in zip(itertools.count(1), images):
-        image.number = format_string.format(n)
+    The entries are keyed by the path. Each entry also records the size,
+    modification time and inode of the file. If any of those differ from the
+    file on disk, the entry is stale and the file has to be parsed again.
 
-def batch_rename(images):
+    The index can be shared between threads. Worker processes open it with
+    ``deferred=True`` and only read from the database. Their changes are
+    sent back with :py:meth:`take_pending` and written by the parent with
+    :py:meth:`write`, such that there is a single writer.
     """
-    Renames a whole batch of images, avoiding temporary name collisions.
 
-    Say you have images like so:
+    def __init__(self, filename=None, deferred=False):
+        """
+        Opens the index, creating it if needed.
 
-    - foo-0.jpg
-    - foo-1.jpg
-    - foo-2.jpg
+        :param filename: Path to the SQLite database, defaults to
+            ``index.sqlite`` in :py:data:`cache_dir`.
+        :param deferred: Whether changes are only collected instead of being
+            written to the database.
+        :type deferred: bool
+        """
+        if filename is None:
+            filename = os.path.join(cache_dir, 'index.sqlite')
 
-    If you use the compress option, the images will be renamed to:
+        dirname = os.path.dirname(filename)
+        if len(dirname) > 0 and not _isdir(dirname):
+            os.makedirs(dirname)
 
-    - foo-1.jpg
-    - foo-2.jpg
-    - foo-3.jpg
+        self.filename = filename
+        self.deferred = deferred
+        self.pending = []
+        """
+        Statements that have not been written because the index is deferred.
+        """
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(filename, check_same_thread=False)
+        self.connection.text_factory = str
+        self._execute(
+            'CREATE TABLE IF NOT EXISTS images ('
+            'path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, '
+            'inode INTEGER, date TEXT, event TEXT, number TEXT, '
+            'suffix TEXT, tags TEXT, keywords TEXT)'
+        )
 
-    The problem is that those names are always in use, so that renaming will
-    fail. This function renames all images to some temporary name and then
-    renames them all back.
-    """
-    for image in images:
-        image.rename_to_temp()
+    def _execute(self, sql, parameters=()):
+        """
+        Executes a statement while holding the lock.
 
-    for image in images:
-        image.rename()
+        :return: All rows of the result.
+        :rtype: list
+        """
+        with self.lock:
+            return self.connection.execute(sql, parameters).fetchall()
+
+    def _change(self, sql, parameters):
+        """
+        Executes a statement that changes the database, or records it if the
+        index is deferred.
+        """
+        if self.deferred:
+            with self.lock:
+                self.pending.append((sql, parameters))
+        else:
+            self._execute(sql, parameters)
+
+    def take_pending(self):
+        """
+        Gives the changes collected by a deferred index and forgets them.
+
+        :return: Statements with their parameters for :py:meth:`write`.
+        :rtype: list
+        """
+        with self.lock:
+            pending = self.pending
+            self.pending = []
+        return pending
+
+    def write(self, pending):
+        """
+        Writes changes that a deferred index has collected and commits them.
+
+        :param pending: Result of :py:meth:`take_pending`.
+        :type pending: list
+        """
+        with self.lock:
+            for sql, parameters in pending:
+                self.connection.execute(sql, parameters)
+            self.connection.commit()
+
+    @staticmethod
+    def _signature(path):
+        """
+        Gives the values that tell whether a file has changed.
+
+        :param path: Path to the file.
+        :return: Tuple with size, modification time in nanoseconds and inode,
+            ``None`` if the file does not exist.
+        :rtype: tuple
+        """
+        try:
+            stat = _stat(path)
+        except OSError:
+            return None
+
+        mtime_ns = getattr(stat, 'st_mtime_ns', None)
+        if mtime_ns is None:
+            mtime_ns = int(stat.st_mtime * 1000000000)
+
+        return (stat.st_size, mtime_ns, stat.st_ino)
+
+    @staticmethod
+    def _join(texts):
+        if texts is None:
+            return None
+        return '\n'.join(texts)
+
+    @staticmethod
+    def _split(joined):
+        if joined is None:
+            return None
+        if len(joined) == 0:
+            return []
+        return joined.split('\n')
+
+    def lookup(self, path):
+        """
+        Gives the entry for the given file if it is up to date.
+
+        :param path: Path to the file.
+        :return: Entry or ``None`` if there is no up-to-date entry.
+        :rtype: IndexEntry
+        """
+        rows = self._execute(
+            'SELECT size, mtime_ns, inode, date, event, number, suffix, tags, '
+            'keywords FROM images WHERE path = ?', (path,)
+        )
+
+        if len(rows) == 0:
+            return None
+
+        row = rows[0]
+
+        if tuple(row[:3]) != self._signature(path):
+            logging.info('Index entry for “{}” is stale.'.format(path))
+            return None
+
+        date, event, number, suffix, tags, keywords = row[3:]
+        return IndexEntry(date, event, number, suffix,
+                          self._split(tags), self._split(keywords))
+
+    def store(self, path, image, tags, keywords):
+        """
+        Stores the metadata of the image.
+
+        Nothing is stored if the file does not exist.
+
+        :param path: Path to the file.
+        :param image: Image with the parsed date, event, number and suffix.
+        :type image: Image
+        :param tags: Tags from the filename.
+        :type tags: list
+        :param keywords: IPTC keywords, ``None`` if they have not been read.
+        :type keywords: list
+        """
+        signature = self._signature(path)
+        if signature is None:
+            return
+
+        self._change(
+            'INSERT OR REPLACE INTO images VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (path,) + signature + (
+                image.date, image.event, image.number, image.suffix,
+                self._join(sorted(str(tag) for tag in tags)),
+                self._join(keywords),
+            )
+        )
+
+    def store_keywords(self, path, keywords):
+        """
+        Adds the IPTC keywords to an existing entry.
+
+        :param path: Path to the file.
+        :param keywords: IPTC keywords.
+        :type keywords: list
+        """
+        self._change(
+            'UPDATE images SET keywords = ? WHERE path = ?',
+            (self._join(keywords), path)
+        )
+
+    def discard(self, path):
+        """
+        Removes the entry for the given path, if there is one.
+
+        :param path: Path to the file.
+        """
+        self._change('DELETE FROM images WHERE path = ?', (path,))
+
+    def commit(self):
+        """
+        Writes pending changes to disk.
+        """
+        with self.lock:
+            self.connection.commit()
+
+    def close(self):
+        """
+        Writes pending changes and closes the database.
+        """
+        with self.lock:
+            self.connection.commit()
+            self.connection.close()
+
+class TagIndex(object):
+    """
+    Inverted index from tags to the images that carry them.
+
+    Every path gets a numeric ID. For each escaped tag, the IDs of the images
+    with that tag are stored in a sorted array. New images get the largest ID
+    so far, therefore the arrays stay sorted when appending.
+    """
+
+    def __init__(self):
+        self.paths = []
+        """
+        Path for each ID, ``None`` for removed images.
+        """
+
+        self.ids = {}
+        """
+        ID for each path.
+        """
+
+        self.postings = {}
+        """
+        Sorted array of IDs for each escaped tag.
+        """
+
+    @classmethod
+    def build(cls, paths):
+        """
+        Creates the index by walking the given paths once.
+
+        Only the filenames are parsed. Files that cannot be parsed are
+        skipped.
+
+        :param paths: Files and directories.
+        :type paths: list
+        :rtype: TagIndex
+        """
+        index = cls()
+        for files in walk_albums(paths):
+            for path in files:
+                try:
+                    image = Image(path)
+                except PictureParseError as e:
+                    logging.info('Skipping “{}”: {}'.format(path, e))
+                    continue
+
+                index.add(path, image.tags)
+
+        return index
+
+    def add(self, path, tags):
+        """
+        Adds an image, replacing it if it is already known.
+
+        :param path: Path to the image.
+        :param tags: Tags of the image.
+        :type tags: set
+        """
+        path = os.path.abspath(path)
+        self.remove(path)
+
+        image_id = len(self.paths)
+        self.paths.append(path)
+        self.ids[path] = image_id
+
+        for tag in tags:
+            escaped = tag.escape()
+            if escaped not in self.postings:
+                self.postings[escaped] = array.array('l')
+            self.postings[escaped].append(image_id)
+
+    def remove(self, path):
+        """
+        Removes an image, if it is known.
+
+        :param path: Path to the image.
+        """
+        path = os.path.abspath(path)
+        image_id = self.ids.pop(path, None)
+        if image_id is None:
+            return
+
+        self.paths[image_id] = None
+        for escaped, posting in list(self.postings.items()):
+            position = bisect.bisect_left(posting, image_id)
+            if position < len(posting) and posting[position] == image_id:
+                del posting[position]
+                if len(posting) == 0:
+                    del self.postings[escaped]
+
+    def update(self, oldname, newname, tags):
+        """
+        Records that an image has been renamed or retagged.
+
+        :param oldname: Path the image had before.
+        :param newname: Path the image has now.
+        :param tags: Tags the image has now.
+        :type tags: set
+        """
+        self.remove(oldname)
+        self.add(newname, tags)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def lookup(self, tag):
+        """
+        Gives the IDs of the images with the given tag.
+
+        :param tag: Tag to look up.
+        :type tag: Tag
+        :return: Sorted IDs.
+        :rtype: array.array
+        """
+        return self.postings.get(tag.escape(), array.array('l'))
+
+    def query(self, words):
+        """
+        Finds the images that match a boolean expression of tags.
+
+        The expression consists of tags, the operators ``and``, ``or`` and
+        ``not`` as well as parentheses. Two tags next to each other are
+        joined with ``and``. Tags are given escaped like in the filenames.
+
+        >>> index = TagIndex()
+        >>> index.add('/a.jpg', set([Tag('Ann')]))
+        >>> index.add('/b.jpg', set([Tag('Anna'), Tag('Martin Ueding')]))
+        >>> index.add('/c.jpg', set([Tag('Ann'), Tag('Martin Ueding')]))
+        >>> index.query(['Martin_Ueding', 'and', 'not', 'Ann'])
+        ['/b.jpg']
+        >>> index.query(['(Ann', 'or', 'Anna)', 'Martin_Ueding'])
+        ['/b.jpg', '/c.jpg']
+
+        :param words: Words of the expression.
+        :type words: list
+        :raises QueryParseError: Raised if the expression is malformed.
+        :return: Sorted paths of the matching images.
+        :rtype: list
+        """
+        parser = _QueryParser(self, _tokenize_query(words))
+        ids = parser.parse()
+        return sorted(self.paths[image_id] for image_id in ids)
+
+    def save(self, filename):
+        """
+        Writes the index to a file.
+
+        :param filename: Path of the file.
+        """
+        dirname = os.path.dirname(filename)
+        if len(dirname) > 0 and not _isdir(dirname):
+            os.makedirs(dirname)
+
+        with open(filename + '.tmp', 'wb') as f:
+            pickle.dump((self.paths, self.postings), f, pickle.HIGHEST_PROTOCOL)
+        os.rename(filename + '.tmp', filename)
+
+    @classmethod
+    def load(cls, filename):
+        """
+        Reads an index from a file written with :py:meth:`save`.
+
+        :param filename: Path of the file.
+        :rtype: TagIndex
+        """
+        index = cls()
+        with open(filename, 'rb') as f:
+            index.paths, index.postings = pickle.load(f)
+        index.ids = dict((path, image_id)
+                         for image_id, path in enumerate(index.paths)
+                         if path is not None)
+        return index
+
+    def replay(self, journal):
+        """
+        Applies the changes recorded by a :py:class:`TagJournal`.
+
+        :param journal: Path of the journal file.
+        :return: Number of changes applied.
+        :rtype: int
+        """
+        if not _isfile(journal):
+            return 0
+
+        count = 0
+        with open(journal) as f:
+            for line in f:
+                fields = line.rstrip('\n').split('\t')
+                if len(fields) < 2:
+                    continue
+                oldname, newname = fields[:2]
+                self.update(oldname, newname,
+                            set(Tag.from_escaped(tag) for tag in fields[2:]))
+                count += 1
+
+        return count
+
+def _tokenize_query(words):
+    """
+    Splits parentheses off the words of a query.
+    """
+    tokens = []
+    for word in words:
+        while word.startswith('('):
+            tokens.append('(')
+            word = word[1:]
+        closing = 0
+        while word.endswith(')'):
+            closing += 1
+            word = word[:-1]
+        if len(word) > 0:
+            tokens.append(word)
+        tokens += [')'] * closing
+    return tokens
+
+class _QueryParser(object):
+    """
+    Recursive descent parser for :py:meth:`TagIndex.query`.
+
+    The grammar is::
+
+        expression := term ('or' term)*
+        term := factor (['and'] factor)*
+        factor := 'not' factor | '(' expression ')' | tag
+    """
+
+    def __init__(self, index, tokens):
+        self.index = index
+        self.tokens = tokens
+        self.position = 0
+
+    def _peek(self):
+        if self.position < len(self.tokens):
+            return self.tokens[self.position]
+        return None
+
+    def _next(self):
+        token = self._peek()
+        if token is None:
+            raise QueryParseError('Unexpected end of query.')
+        self.position += 1
+        return token
+
+    def parse(self):
+        ids = self._expression()
+        if self._peek() is not None:
+            raise QueryParseError('Unexpected “{}”.'.format(self._peek()))
+        return ids
+
+    def _expression(self):
+        ids = self._term()
+        while self._peek() == 'or':
+            self._next()
+            ids = ids | self._term()
+        return ids
+
+    def _term(self):
+        ids = self._factor()
+        while self._peek() not in (None, 'or', ')'):
+            if self._peek() == 'and':
+                self._next()
+            ids = ids & self._factor()
+        return ids
+
+    def _factor(self):
+        token = self._next()
+        if token == 'not':
+            return set(self.index.ids.values()) - self._factor()
+        if token == '(':
+            ids = self._expression()
+            if self._next() != ')':
+                raise QueryParseError('Missing “)”.')
+            return ids
+        if token in ('and', 'or', ')'):
+            raise QueryParseError('Unexpected “{}”.'.format(token))
+        return set(self.index.lookup(Tag.from_escaped(token)))
+
+class TagJournal(object):
+    """
+    Records renamed and retagged images for a :py:class:`TagIndex`.
+
+    Instances are meant to be added to :py:data:`change_listeners`. Every
+    change is appended to the journal file as a line with the old path, the
+    new path and the escaped tags, separated by tabs.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = threading.Lock()
+
+    def __call__(self, oldname, image):
+        fields = [os.path.abspath(oldname), os.path.abspath(image.origname)]
+        fields += sorted(tag.escape() for tag in image.tags)
+        with self.lock:
+            with open(self.filename, 'a') as f:
+                f.write('\t'.join(fields) + '\n')
+
+tag_index_file = os.path.join(cache_dir, 'tags.index')
+"""
+Default location of the :py:class:`TagIndex`. Its journal has the same name
+with ``.journal`` appended.
+"""
+
+def journal_tag_changes(filename=None):
+    """
+    Records all changes to images for the tag index, if there is one.
+
+    :param filename: Path of the tag index, defaults to
+        :py:data:`tag_index_file`.
+    """
+    if filename is None:
+        filename = tag_index_file
+
+    if _isfile(filename):
+        change_listeners.append(TagJournal(filename + '.journal'))
+
+class PictureDBError(Exception):
+    """
+    Exception class for this module.
+    """
+    pass
+
+class PictureParseError(PictureDBError):
+    """
+    General exception class for parsing the information in the file names.
+    """
+    pass
+
+class FilenameParseError(PictureParseError):
+    pass
+
+class FolderParseError(PictureParseError):
+    pass
+
+class PrefixParseError(FilenameParseError):
+    pass
+
+class NumberParseError(PrefixParseError):
+    pass
+
+class EventParseError(PrefixParseError, FolderParseError):
+    """
+    Error related to the parsing of the event from either folder or image.
+    """
+    pass
+
+class DateParseError(PrefixParseError, FolderParseError):
+    """
+    Error related to the parsing the date from either the folder or the image
+    file.
+    """
+    pass
+
+class FilenameTooLongError(PictureDBError):
+    pass
+
+class JPEGFormatError(PictureDBError):
+    """
+    The file is not a JPEG file whose metadata can be handled natively.
+    """
+    pass
+
+class RenameCollisionError(PictureDBError):
+    """
+    The new name of an image is already taken.
+    """
+    pass
+
+class QueryParseError(PictureDBError):
+    """
+    Error in the boolean expression of a tag query.
+    """
+    pass
+
+class ServiceError(PictureDBError):
+    """
+    The service of :py:class:`PictureService` cannot be reached.
+    """
+    pass
+
+def _longest_nondecreasing(values):
+    """
+    Finds a longest non-decreasing subsequence.
+
+    >>> _longest_nondecreasing([3, 1, 2, 2, 0, 5])
+    [1, 2, 3, 5]
+
+    :param values: Values to look at.
+    :type values: list
+    :return: Positions of the subsequence.
+    :rtype: list
+    """
+    tails = []
+    tail_positions = []
+    previous = [None] * len(values)
+    for position, value in enumerate(values):
+        length = bisect.bisect_right(tails, value)
+        if length > 0:
+            previous[position] = tail_positions[length - 1]
+        if length == len(tails):
+            tails.append(value)
+            tail_positions.append(position)
+        else:
+            tails[length] = value
+            tail_positions[length] = position
+
+    result = []
+    position = tail_positions[-1] if len(tail_positions) > 0 else None
+    while position is not None:
+        result.append(position)
+        position = previous[position]
+    return result[::-1]
+
+def _kept_numbers(numbers, width):
+    """
+    Finds the most images that can keep their number with the given width.
+
+    Keeping the numbers of images ``i < j`` leaves room for the images
+    between them if ``n_j - n_i >= j - i``, that is if ``n_i - i`` does not
+    decrease. The first and the last kept number also need room for the
+    images before and after them.
+
+    :param numbers: Present numbers as strings.
+    :type numbers: list
+    :param width: Number of digits.
+    :type width: int
+    :return: Positions of the images that keep their numbers.
+    :rtype: list
+    """
+    count = len(numbers)
+    largest = 10**width - 1
+    candidates = []
+    for position, number in enumerate(numbers):
+        if len(number) != width or not number.isdigit():
+            continue
+        offset = int(number) - position
+        if 1 <= offset and offset + count - 1 <= largest:
+            candidates.append((position, offset))
+
+    chosen = _longest_nondecreasing([offset for position, offset in candidates])
+    return [candidates[index][0] for index in chosen]
+
+def compress_numbers(images, minimal=False):
+    """
+    Compresses the numbers in the filenames.
+
+    This has to be done to a whole collection so that they are numbered
+    correctly. The number of images are taken into account when padding the
+    number with leadings zeros.
+
+    Usually the images are numbered from one. With ``minimal``, the numbers
+    only have to increase and as many images as possible keep theirs, such
+    that removing an image does not renumber all the ones after it. A wider
+    padding that the images already have is kept then.
+
+    >>> images = [Image('20120204-Klopapierberg-{}.jpg'.format(n)) for n in ['01', '03', '04', 'x']]
+    >>> compress_numbers(images, minimal=True)
+    >>> [image.number for image in images]
+    ['01', '03', '04', '05']
+
+    :param images: Images to rename.
+    :type images: list
+    :param minimal: Whether to change as few numbers as possible.
+    :type minimal: bool
+    """
+    if minimal:
+        _compress_numbers_minimal(images)
+        return
+
+    image_count = len(images)
+    digit_count = len(str(image_count))
+    format_string = '{:0'+str(digit_count)+'d}'
+
+    for n, image in zip(itertools.count(1), images):
+        image.number = format_string.format(n)
+
+def _compress_numbers_minimal(images):
+    numbers = [image.number for image in images]
+
+    # Every width from the shortest possible one up to the ones already in
+    # use is tried.
+    shortest = len(str(len(images)))
+    widths = set([shortest])
+    widths.update(len(number) for number in numbers
+                  if number.isdigit() and len(number) > shortest)
+
+    best = None
+    for width in sorted(widths):
+        kept = _kept_numbers(numbers, width)
+        if best is None or len(kept) > len(best[1]):
+            best = (width, kept)
+
+    width, kept = best
+    format_string = '{:0' + str(width) + 'd}'
+    kept = set(kept)
+
+    n = 0
+    for position, image in enumerate(images):
+        if position in kept:
+            n = int(image.number)
+        else:
+            n += 1
+            image.number = format_string.format(n)
+
+collision_policies = ['bump', 'skip', 'fail']
+"""
+What :py:func:`plan_renames` can do if the new name of an image is taken:
+
+``bump``
+    Increase the number until the name is free.
+``skip``
+    Leave the image under its old name.
+``fail``
+    Raise :py:class:`RenameCollisionError`.
+"""
+
+def _bump_number(number):
+    """
+    Increases the number by one, keeping the leading zeros.
+
+    >>> _bump_number('0099')
+    '0100'
+    """
+    return str(int(number) + 1).zfill(len(number))
+
+def plan_renames(images, listings=None, policy='bump'):
+    """
+    Resolves all name collisions of a batch of images up front.
+
+    The new names are checked against a snapshot of the directories, where
+    the old names of the images in the batch that change their name count as
+    free and names claimed by earlier images in the batch count as taken. Nothing is renamed and no
+    file is looked at, apart from listing the directories that are not in
+    the snapshot once.
+
+    :param images: Images to rename.
+    :type images: list
+    :param listings: Names in each directory, by directory. Directories that
+        are missing are listed.
+    :type listings: dict
+    :param policy: One of :py:data:`collision_policies`.
+    :raises RenameCollisionError: Raised with the ``fail`` policy.
+    :return: Images that have to be renamed, in the given order.
+    :rtype: list
+    """
+    if policy not in collision_policies:
+        raise ValueError('Unknown collision policy “{}”.'.format(policy))
+
+    if listings is None:
+        listings = {}
+    for image in images:
+        if image.dirname not in listings:
+            stats.count('directories listed')
+            listings[image.dirname] = set(os.listdir(image.dirname or '.'))
+
+    numbers = [image.number for image in images]
+    skipped = set()
+
+    # Skipping an image keeps its old name taken, which may collide with an
+    # image before it. Repeat until no more images are skipped.
+    while True:
+        for image, number in zip(images, numbers):
+            image.number = number
+
+        taken = dict((dirname, set(names)) for dirname, names in listings.items())
+        for image in images:
+            if image not in skipped and image.name_changed():
+                taken[image.dirname].discard(image.basename)
+
+        result = []
+        new_skips = False
+        for image in images:
+            names = taken[image.dirname]
+            if image in skipped:
+                names.add(image.basename)
+                continue
+
+            newname = os.path.basename(image.current_path())
+            if newname in names and newname != image.basename:
+                if policy == 'fail':
+                    raise RenameCollisionError(
+                        'File “{}” already exists.'.format(image.current_path()))
+                elif policy == 'skip':
+                    logging.info('Skipping “{}”, “{}” already exists.'.format(
+                        image.origname, newname))
+                    skipped.add(image)
+                    new_skips = True
+                    continue
+                else:
+                    while newname in names:
+                        image.number = _bump_number(image.number)
+                        newname = os.path.basename(image.current_path())
+
+            names.add(newname)
+            if image.name_changed():
+                result.append(image)
+
+        if not new_skips:
+            return result
+
+def batch_rename(images, journal=None, policy='bump', listings=None):
+    """
+    Renames a whole batch of images, avoiding temporary name collisions.
+
+    Say you have images like so:
+
+    - foo-0.jpg
+    - foo-1.jpg
+    - foo-2.jpg
+
+    If you use the compress option, the images will be renamed to:
+
+    - foo-1.jpg
+    - foo-2.jpg
+    - foo-3.jpg
+
+    The problem is that those names are in use until the other images have
+    been moved away. The renames are therefore ordered with
+    :py:func:`plan_rename_steps` such that every image is renamed directly
+    once its new name is free. Only cycles need a temporary name. Collisions
+    with other files are resolved beforehand with :py:func:`plan_renames`.
+
+    :param images: Images to rename.
+    :type images: list
+    :param journal: Path of a journal for :py:func:`rename_files`.
+    :param policy: One of :py:data:`collision_policies`.
+    :param listings: Snapshot of the directories for :py:func:`plan_renames`.
+    :type listings: dict
+    """
+    renamed = plan_renames(images, listings, policy)
+    moves = [(image.origname, image.current_path()) for image in renamed]
+
+    rename_files(moves, journal)
+
+    for image, (oldname, newname) in zip(renamed, moves):
+        image._set_origname(newname)
+
+def plan_rename_steps(moves):
+    """
+    Orders the renames such that no file is overwritten.
+
+    The moves form a graph where a move has to wait until the file at its
+    destination has been moved away itself. Chains are resolved by renaming
+    from the end of the chain. Only for cycles, one file is moved to a
+    temporary name in its own directory first.
+
+    >>> plan_rename_steps([('a', 'b'), ('b', 'c')])
+    [('b', 'c'), ('a', 'b')]
+    >>> steps = plan_rename_steps([('d/a', 'd/b'), ('d/b', 'd/a')])
+    >>> len(steps), steps[0][0], steps[1], steps[2][1]
+    (3, 'd/a', ('d/b', 'd/a'), 'd/b')
+
+    :param moves: Pairs of old and new path. The old and the new paths must
+        be unique among themselves.
+    :type moves: list
+    :return: Pairs of old and new path in the order they have to be done.
+    :rtype: list
+    """
+    pending = dict((src, dst) for src, dst in moves if src != dst)
+    incoming = dict((dst, src) for src, dst in pending.items())
+
+    ready = sorted((src for src, dst in pending.items() if dst not in pending),
+                   reverse=True)
+    steps = []
+
+    while len(pending) > 0:
+        if len(ready) == 0:
+            # Everything left consists of cycles. Break one of them.
+            src = min(pending)
+            temp = os.path.join(os.path.dirname(src),
+                                '.pdb-rename-{}'.format(uuid.uuid4().hex))
+            steps.append((src, temp))
+            dst = pending.pop(src)
+            pending[temp] = dst
+            incoming[dst] = temp
+            ready.append(incoming.pop(src))
+            continue
+
+        src = ready.pop()
+        dst = pending.pop(src)
+        steps.append((src, dst))
+
+        # The source is free now, the move waiting for it can go ahead.
+        waiting = incoming.pop(src, None)
+        if waiting is not None:
+            ready.append(waiting)
+
+    return steps
+
+rename_journal_file = os.path.join(cache_dir, 'rename-{}.journal'.format(os.getpid()))
+"""
+Default location of the journal of :py:func:`rename_files`.
+
+Every process has a journal of its own, such that ``hashtag``, ``pdb-watch``
+and ``pdb-service`` can rename files at the same time.
+:py:func:`unfinished_rename_journals` finds the journals of all processes.
+"""
+
+def _lock_journal(f):
+    """
+    Locks an open journal file for this process.
+
+    :return: Whether the lock could be taken. It cannot if another process
+        is still working with the journal.
+    :rtype: bool
+    """
+    try:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError as e:
+        if e.errno in (errno.EAGAIN, errno.EACCES):
+            return False
+        raise
+    return True
+
+def unfinished_rename_journals(directory=cache_dir):
+    """
+    Finds the rename journals that were left behind by interrupted runs.
+
+    A journal is locked as long as its :py:func:`rename_files` run is going
+    on, journals of runs in other processes are therefore not listed.
+
+    :param directory: Directory with the journals.
+    :return: Paths of the journals.
+    :rtype: list
+    """
+    result = []
+    for journal in sorted(glob.glob(os.path.join(directory, 'rename*.journal'))):
+        try:
+            with open(journal) as f:
+                if _lock_journal(f):
+                    result.append(journal)
+        except IOError:
+            # The run finished while we were looking.
+            pass
+    return result
+
+def _journal_line(*fields):
+    for field in fields:
+        if '\t' in field or '\n' in field:
+            raise PictureDBError('Cannot journal “{}”.'.format(field))
+    return '\t'.join(fields) + '\n'
+
+def rename_files(moves, journal=None):
+    """
+    Renames files in an order that does not overwrite any of them.
+
+    If a journal is given, all the steps are written to it and synced to disk
+    before the first file is touched. Every completed step is recorded and
+    synced, too, so at most the step that was running is missing after a
+    crash. An interrupted run can then be resumed or rolled back with
+    :py:func:`recover_renames`. The journal is removed once all files have
+    been renamed.
+
+    :param moves: Pairs of old and new path.
+    :type moves: list
+    :param journal: Path of the journal file or ``None``.
+    :raises PictureDBError: Raised if there is an unfinished journal.
+    """
+    steps = [(os.path.abspath(src), os.path.abspath(dst))
+             for src, dst in plan_rename_steps(moves)]
+
+    if len(steps) == 0:
+        return
+
+    stats.count('renames', len(steps))
+
+    if journal is None:
+        with stats.timer('rename'):
+            for src, dst in steps:
+                logging.info('Renaming “{}” to “{}”.'.format(src, dst))
+                os.rename(src, dst)
+        return
+
+    if _exists(journal):
+        raise PictureDBError(
+            'There is an unfinished rename journal at “{}”, recover it first.'
+            .format(journal))
+
+    dirname = os.path.dirname(journal)
+    if len(dirname) > 0 and not _isdir(dirname):
+        os.makedirs(dirname)
+
+    # The journal is only moved into place once it is locked and complete,
+    # such that a recovery in another process never sees it half written.
+    with open(journal + '.new', 'w') as f:
+        _lock_journal(f)
+        for src, dst in steps:
+            f.write(_journal_line('step', src, dst))
+        f.write(_journal_line('planned'))
+        f.flush()
+        os.fsync(f.fileno())
+        os.rename(journal + '.new', journal)
+
+        for number, (src, dst) in enumerate(steps):
+            logging.info('Renaming “{}” to “{}”.'.format(src, dst))
+            with stats.timer('rename'):
+                os.rename(src, dst)
+            f.write(_journal_line('done', str(number)))
+            f.flush()
+            os.fsync(f.fileno())
+
+    os.remove(journal)
+
+def _recovery_rename(src, dst):
+    if _lexists(dst):
+        raise PictureDBError(
+            'Cannot recover, “{}” would overwrite “{}”.'.format(src, dst))
+    os.rename(src, dst)
+
+def recover_renames(journal, rollback=False):
+    """
+    Finishes or undoes a :py:func:`rename_files` run that was interrupted.
+
+    The steps that were done last may not have been recorded. Whether they
+    happened is decided by looking at the files: a step whose source is gone
+    and whose destination exists is done. No file is ever overwritten, if a
+    step would do that, the recovery stops and the journal is kept.
+
+    :param journal: Path of the journal file.
+    :param rollback: Whether to undo the renames instead of finishing them.
+    :type rollback: bool
+    :raises PictureDBError: Raised if another process still works with the
+        journal or if a step would overwrite a file.
+    :return: Number of files renamed during the recovery.
+    :rtype: int
+    """
+    # The journal stays locked during the recovery, such that no other
+    # process recovers it at the same time.
+    with open(journal) as f:
+        if not _lock_journal(f):
+            raise PictureDBError(
+                'The rename journal “{}” is still in use.'.format(journal))
+
+        steps = []
+        planned = False
+        done = 0
+        for line in f:
+            fields = line.rstrip('\n').split('\t')
+            if fields[0] == 'step':
+                steps.append((fields[1], fields[2]))
+            elif fields[0] == 'planned':
+                planned = True
+            elif fields[0] == 'done':
+                done = int(fields[1]) + 1
+
+        # A plan that was not written completely was never started.
+        if not planned:
+            os.remove(journal)
+            return 0
+
+        while done < len(steps):
+            src, dst = steps[done]
+            if _exists(src) or not _exists(dst):
+                break
+            done += 1
+
+        count = 0
+        if rollback:
+            for src, dst in reversed(steps[:done]):
+                logging.info('Rolling back “{}” to “{}”.'.format(dst, src))
+                _recovery_rename(dst, src)
+                count += 1
+        else:
+            for src, dst in steps[done:]:
+                logging.info('Renaming “{}” to “{}”.'.format(src, dst))
+                _recovery_rename(src, dst)
+                count += 1
+
+        os.remove(journal)
+
+    return count
+
+def parallel_map(function, items, jobs=1):
+    """
+    Applies the function to every item, using a pool of threads.
+
+    The work is mostly file I/O, so threads are sufficient. The results are
+    in the same order as the items, no matter in which order the threads
+    finish.
+
+    :param function: Function to call with each item.
+    :param items: Items to process.
+    :type items: list
+    :param jobs: Number of threads, ``1`` does everything in this thread.
+    :type jobs: int
+    :return: Results of the function calls.
+    :rtype: list
+    """
+    if jobs <= 1 or len(items) <= 1:
+        return [function(item) for item in items]
+
+    pool = multiprocessing.pool.ThreadPool(min(jobs, len(items)))
+    try:
+        return pool.map(function, items)
+    finally:
+        pool.close()
+        pool.join()
+
+def process_map(function, items, processes=1):
+    """
+    Applies the function to every item, using a pool of processes.
+
+    This is meant for independent albums, where parsing and planning is
+    bound by the CPU and threads would not help. The function and the items
+    have to be picklable. The results are yielded in the order of the items
+    as soon as they are available.
+
+    :param function: Function to call with each item.
+    :param items: Iterable with the items.
+    :param processes: Number of processes, ``1`` does everything in this
+        process.
+    :type processes: int
+    :return: Generator of the results.
+    """
+    if processes <= 1:
+        for item in items:
+            yield function(item)
+        return
+
+    pool = multiprocessing.pool.Pool(processes)
+    try:
+        for result in pool.imap(function, items):
+            yield result
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+def _write_iptc_if_changed(image):
+    if image.iptc_changed():
+        image.write_iptc()
+
+def batch_save(images, jobs=1, journal=None, policy='bump'):
+    """
+    Saves a whole batch of images.
+
+    The IPTC fields are written in parallel, the files are then renamed with
+    :py:func:`batch_rename`.
+
+    :param images: Images to save.
+    :type images: list
+    :param jobs: Number of threads to write the IPTC fields with.
+    :type jobs: int
+    :param journal: Path of a journal for :py:func:`rename_files`.
+    :param policy: One of :py:data:`collision_policies`.
+    """
+    parallel_map(_write_iptc_if_changed, images, jobs)
+    batch_rename([image for image in images if image.name_changed()], journal, policy)
+
+def make_plan(renamed, rewritten):
+    """
+    Creates a plan of the changes to the given images.
+
+    The collisions have to be resolved with :py:func:`plan_renames` already.
+    The IPTC entries refer to the files before they are renamed. All paths
+    are absolute, such that the plan can be applied from any directory.
+
+    :param renamed: Images that are to be renamed.
+    :type renamed: list
+    :param rewritten: Images whose IPTC keywords are to be written.
+    :type rewritten: list
+    :return: Entries of the plan, dicts with an ``action`` key.
+    :rtype: list
+    """
+    entries = []
+    for image in rewritten:
+        entries.append({
+            'action': 'iptc',
+            'path': os.path.abspath(image.origname),
+            'keywords': [str(tag) for tag in sorted(image.get_tags())],
+        })
+    for image in renamed:
+        entries.append({
+            'action': 'rename',
+            'src': os.path.abspath(image.origname),
+            'dst': os.path.abspath(image.current_path()),
+        })
+    return entries
+
+def write_plan(entries, f):
+    """
+    Writes plan entries to a file, one JSON object per line.
+
+    :param entries: Entries from :py:func:`make_plan`.
+    :type entries: list
+    :param f: File opened for writing.
+    """
+    for entry in entries:
+        f.write(json.dumps(entry, sort_keys=True) + '\n')
+
+def _native(value):
+    """
+    Turns the unicode strings that :py:mod:`json` gives into UTF-8 strings.
+    """
+    if isinstance(value, list):
+        return [_native(item) for item in value]
+    if isinstance(value, dict):
+        return dict((_native(key), _native(item)) for key, item in value.items())
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+_plan_fields = {
+    'iptc': ['path', 'keywords'],
+    'rename': ['src', 'dst'],
+}
+
+def read_plan(f):
+    """
+    Reads a plan that was written with :py:func:`write_plan`.
+
+    :param f: File opened for reading.
+    :return: Entries of the plan.
+    :rtype: list
+    :raises PictureDBError: Raised if a line is not a valid entry.
+    """
+    return list(iter_plan(f))
+
+def iter_plan(f):
+    """
+    Reads the entries of a plan one by one, without holding all of them.
+
+    :param f: File opened for reading.
+    :return: Generator of entries.
+    :raises PictureDBError: Raised if a line is not a valid entry.
+    """
+    for number, line in enumerate(f, 1):
+        if len(line.strip()) == 0:
+            continue
+        try:
+            entry = json.loads(line)
+            fields = _plan_fields[entry['action']]
+            entry = dict([('action', str(entry['action']))] +
+                         [(field, _native(entry[field])) for field in fields])
+        except (ValueError, KeyError, TypeError, AttributeError):
+            raise PictureDBError('Line {} of the plan is not valid.'.format(number))
+        yield entry
+
+def _plan_directory(entry):
+    return os.path.dirname(entry.get('path') or entry['src'])
+
+def iter_plan_albums(f):
+    """
+    Reads a plan that was written album by album, one album at a time.
+
+    Consecutive entries in the same directory form an album.
+
+    :param f: File opened for reading.
+    :return: Generator of tuples with the directory and its entries.
+    :raises PictureDBError: Raised if a line is not a valid entry.
+    """
+    for directory, entries in itertools.groupby(iter_plan(f), _plan_directory):
+        yield directory, list(entries)
+
+def _save_plan_keywords(entry):
+    save_keywords(entry['path'], entry['keywords'])
+
+def apply_plan(entries, jobs=1, journal=None):
+    """
+    Carries out a plan without looking at the images again.
+
+    The IPTC keywords are written first, then all files are renamed with
+    :py:func:`rename_files`. Nothing is changed if a file of the plan is
+    missing or a new name is taken by now.
+
+    :param entries: Entries from :py:func:`read_plan`.
+    :type entries: list
+    :param jobs: Number of threads to write the IPTC fields with.
+    :type jobs: int
+    :param journal: Path of a journal for :py:func:`rename_files`.
+    :raises PictureDBError: Raised if the plan does not fit the files.
+    """
+    rewritten = [entry for entry in entries if entry['action'] == 'iptc']
+    moves = [(entry['src'], entry['dst'])
+             for entry in entries if entry['action'] == 'rename']
+
+    sources = set(os.path.abspath(src) for src, dst in moves)
+    for path in [entry['path'] for entry in rewritten] + [src for src, dst in moves]:
+        if not _isfile(path):
+            raise PictureDBError('“{}” from the plan does not exist.'.format(path))
+    for src, dst in moves:
+        if _lexists(dst) and os.path.abspath(dst) not in sources:
+            raise RenameCollisionError('“{}” already exists.'.format(dst))
+
+    parallel_map(_save_plan_keywords, rewritten, jobs)
+    rename_files(moves, journal)
+
+    if len(change_listeners) > 0:
+        for src, dst in moves:
+            image = Image(dst)
+            for listener in change_listeners:
+                listener(src, image)
+
+def _list_directory(path):
+    """
+    Lists a directory together with the type of each entry.
+
+    With :py:func:`os.scandir`, the type comes from the directory entry itself
+    and no extra ``stat`` call is needed.
+
+    :param path: Directory to list.
+    :return: Tuples with path, whether it is a directory and whether it is a
+        file, sorted by path.
+    :rtype: list
+    """
+    stats.count('directories listed')
+    if scandir is None:
+        entries = []
+        for name in os.listdir(path):
+            entry_path = os.path.join(path, name)
+            entries.append((entry_path, _isdir(entry_path),
+                            _isfile(entry_path)))
+    else:
+        entries = [(entry.path, entry.is_dir(), entry.is_file())
+                   for entry in scandir(path)]
+
+    entries.sort()
+    return entries
+
+def _accept_file(filename, include, exclude, backups):
+    """
+    Checks whether the file passes the filter of :py:func:`walk_albums`.
+    """
+    if not backups and filename.endswith('~'):
+        return False
+
+    extension = os.path.splitext(filename)[1][1:].lower()
+
+    if include is not None and extension not in include:
+        return False
+    if exclude is not None and extension in exclude:
+        return False
+
+    return True
+
+def walk_albums(paths, include=None, exclude=None, backups=False):
+    """
+    Walks the given paths and yields the files directory by directory.
+
+    The files given directly are yielded first as one batch. Then every
+    directory is walked depth first, where the files of a directory are
+    yielded before its subdirectories are entered. Only a single directory
+    listing and the subdirectories still to visit are held in memory.
+
+    :param paths: Files and directories.
+    :type paths: list
+    :param include: Extensions to accept like ``jpg``, all if ``None``.
+    :param exclude: Extensions to skip.
+    :param backups: Whether backup files ending in ``~`` are accepted.
+    :type backups: bool
+    :return: Generator of lists of paths, sorted within each list.
+    """
+    if include is not None:
+        include = set(extension.lower() for extension in include)
+    if exclude is not None:
+        exclude = set(extension.lower() for extension in exclude)
+
+    files = []
+    folders = []
+    for path in paths:
+        if _isdir(path):
+            folders.append(path)
+        elif _isfile(path):
+            if _accept_file(path, include, exclude, backups):
+                files.append(path)
+
+    if len(files) > 0:
+        yield sorted(files)
+
+    stack = list(reversed(folders))
+    while len(stack) > 0:
+        folder = stack.pop()
+        files = []
+        subfolders = []
+        with stats.timer('walk'):
+            for path, is_dir, is_file in _list_directory(folder):
+                if is_dir:
+                    subfolders.append(path)
+                elif is_file and _accept_file(path, include, exclude, backups):
+                    files.append(path)
+
+        stats.count('files scanned', len(files))
+        if len(files) > 0:
+            yield files
+
+        stack.extend(reversed(subfolders))
+
+def build_tag_map(paths, tags):
+    """
+    Finds the images that have any of the given tags.
+
+    The paths are walked only once for all the tags. Only the filenames are
+    parsed. Files that cannot be parsed are skipped.
+
+    :param paths: Files and directories to search.
+    :type paths: list
+    :param tags: Tags to look for.
+    :type tags: list
+    :return: Dictionary from each tag to the list of paths that have it.
+    :rtype: dict
+    """
+    tag_map = dict((tag, []) for tag in tags)
+    wanted = set(tags)
+
+    for files in walk_albums(paths):
+        for path in files:
+            try:
+                image = Image(path)
+            except PictureParseError as e:
+                logging.info('Skipping “{}”: {}'.format(path, e))
+                continue
+
+            for tag in image.tags & wanted:
+                tag_map[tag].append(path)
+
+    return tag_map
+
+def sync_symlinks(directory, targets):
+    """
+    Makes the directory contain relative symlinks to exactly the given files.
+
+    Links that already point to the right file are left alone, only missing
+    links are created and superfluous ones are removed. Entries that are not
+    symlinks are not touched.
+
+    :param directory: Directory with the links, created if needed.
+    :param targets: Paths the links should point to.
+    :type targets: list
+    :return: Tuple with the lists of names that were added and removed.
+    :rtype: tuple
+    """
+    if not _isdir(directory):
+        os.makedirs(directory)
+
+    wanted = {}
+    for target in targets:
+        wanted[os.path.basename(target)] = os.path.relpath(target, directory)
+
+    existing = {}
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        if _islink(path):
+            existing[name] = os.readlink(path)
+
+    removed = []
+    for name, link in sorted(existing.items()):
+        if wanted.get(name) != link:
+            os.remove(os.path.join(directory, name))
+            removed.append(name)
+
+    added = []
+    for name, link in sorted(wanted.items()):
+        if existing.get(name) != link:
+            os.symlink(link, os.path.join(directory, name))
+            added.append(name)
+
+    return added, removed
+
+dedup_chunk_size = 1 << 16
+"""
+Number of bytes at the start and at the end of a file that
+:py:func:`find_duplicates` compares before hashing whole files.
+"""
+
+class HashCache(object):
+    """
+    Persistent cache of the content hashes of files.
+
+    The hashes are keyed by inode and modification time, so they stay valid
+    when a file is renamed, which happens all the time in the picture
+    database. The size is checked as well.
+
+    The cache can be shared between threads.
+    """
+
+    _kinds = ['quick', 'full']
+
+    def __init__(self, filename=None):
+        """
+        Opens the cache, creating it if needed.
+
+        :param filename: Path to the SQLite database, defaults to
+            ``hashes.sqlite`` in :py:data:`cache_dir`.
+        """
+        if filename is None:
+            filename = os.path.join(cache_dir, 'hashes.sqlite')
+
+        dirname = os.path.dirname(filename)
+        if len(dirname) > 0 and not _isdir(dirname):
+            os.makedirs(dirname)
+
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(filename, check_same_thread=False)
+        self.connection.text_factory = str
+        self._execute(
+            'CREATE TABLE IF NOT EXISTS hashes ('
+            'inode INTEGER, mtime_ns INTEGER, size INTEGER, quick TEXT, '
+            'full TEXT, PRIMARY KEY (inode, mtime_ns))'
+        )
+
+    def _execute(self, sql, parameters=()):
+        with self.lock:
+            return self.connection.execute(sql, parameters).fetchall()
+
+    def lookup(self, signature, kind):
+        """
+        Gives a cached hash.
+
+        :param signature: Signature of the file as given by
+            :py:meth:`MetadataIndex._signature`.
+        :type signature: tuple
+        :param kind: ``quick`` or ``full``.
+        :return: Hash or ``None`` if it is not known.
+        :rtype: str
+        """
+        if kind not in self._kinds:
+            raise ValueError('Unknown hash “{}”.'.format(kind))
+
+        size, mtime_ns, inode = signature
+        rows = self._execute(
+            'SELECT size, {} FROM hashes WHERE inode = ? AND mtime_ns = ?'.format(kind),
+            (inode, mtime_ns)
+        )
+        if len(rows) == 0 or rows[0][0] != size:
+            return None
+        return rows[0][1]
+
+    def store(self, signature, kind, digest):
+        """
+        Caches a hash.
+
+        :param signature: Signature of the file.
+        :type signature: tuple
+        :param kind: ``quick`` or ``full``.
+        :param digest: Hash of the file.
+        """
+        if kind not in self._kinds:
+            raise ValueError('Unknown hash “{}”.'.format(kind))
+
+        size, mtime_ns, inode = signature
+        with self.lock:
+            self.connection.execute(
+                'DELETE FROM hashes WHERE inode = ? AND mtime_ns = ? AND size != ?',
+                (inode, mtime_ns, size))
+            self.connection.execute(
+                'INSERT OR IGNORE INTO hashes (inode, mtime_ns, size) VALUES (?, ?, ?)',
+                (inode, mtime_ns, size))
+            self.connection.execute(
+                'UPDATE hashes SET {} = ? WHERE inode = ? AND mtime_ns = ?'.format(kind),
+                (digest, inode, mtime_ns))
+
+    def close(self):
+        """
+        Writes pending changes and closes the database.
+        """
+        with self.lock:
+            self.connection.commit()
+            self.connection.close()
+
+def _quick_hash(path, size):
+    """
+    Hashes the first and the last :py:data:`dedup_chunk_size` bytes.
+    """
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        if size <= 2 * dedup_chunk_size:
+            data = f.read()
+            digest.update(data)
+            stats.count('bytes hashed', len(data))
+        else:
+            digest.update(f.read(dedup_chunk_size))
+            f.seek(-dedup_chunk_size, os.SEEK_END)
+            digest.update(f.read(dedup_chunk_size))
+            stats.count('bytes hashed', 2 * dedup_chunk_size)
+    return digest.hexdigest()
+
+def _full_hash(path):
+    """
+    Hashes the whole file, reading it in chunks.
+    """
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(1 << 20)
+            if len(chunk) == 0:
+                break
+            digest.update(chunk)
+            stats.count('bytes hashed', len(chunk))
+    return digest.hexdigest()
+
+def _hash_function(kind, signatures, cache):
+    def function(path):
+        signature = signatures[path]
+        if cache is not None:
+            digest = cache.lookup(signature, kind)
+            if digest is not None:
+                return digest
+
+        if kind == 'quick':
+            digest = _quick_hash(path, signature[0])
+        else:
+            digest = _full_hash(path)
+
+        if cache is not None:
+            cache.store(signature, kind, digest)
+        return digest
+    return function
+
+def _refine_groups(groups, function, jobs):
+    """
+    Splits the groups of paths further by the result of the function.
+
+    :return: Groups with more than one path.
+    :rtype: list
+    """
+    pairs = [(number, path) for number, group in enumerate(groups) for path in group]
+    digests = parallel_map(function, [path for number, path in pairs], jobs)
+
+    refined = collections.defaultdict(list)
+    for (number, path), digest in zip(pairs, digests):
+        refined[(number, digest)].append(path)
+
+    return [group for key, group in sorted(refined.items()) if len(group) > 1]
+
+def find_duplicates(paths, jobs=1, cache=None):
+    """
+    Finds files with the same content.
+
+    Only files of the same size are compared. Their first and last bytes are
+    hashed next, and only the files that still match are hashed completely.
+    Empty files are ignored.
+
+    :param paths: Files and directories.
+    :type paths: list
+    :param jobs: Number of threads to read the files with.
+    :type jobs: int
+    :param cache: Cache for the hashes.
+    :type cache: HashCache
+    :return: Groups of duplicates, each a sorted list of paths.
+    :rtype: list
+    """
+    signatures = {}
+    by_size = collections.defaultdict(list)
+    for files in walk_albums(paths):
+        for path in files:
+            signature = MetadataIndex._signature(path)
+            if signature is None or signature[0] == 0:
+                continue
+            signatures[path] = signature
+            by_size[signature[0]].append(path)
+
+    groups = [group for size, group in sorted(by_size.items()) if len(group) > 1]
+    groups = _refine_groups(groups, _hash_function('quick', signatures, cache), jobs)
+    groups = _refine_groups(groups, _hash_function('full', signatures, cache), jobs)
+
+    return sorted(sorted(group) for group in groups)
+
+def _load_duplicates(group, index, iptc, jobs):
+    """
+    Creates the images of a group of duplicates.
+
+    :return: Images or ``None`` if one of the files cannot be used.
+    :rtype: list
+    """
+    images = []
+    for path in group:
+        try:
+            images.append(Image(path, index))
+        except (PictureDBError, IOError, OSError) as e:
+            logging.warning('Skipping the copies of “{}”: {}'.format(group[0], e))
+            return None
+
+    if iptc:
+        try:
+            parallel_map(Image.load_iptc, images, jobs)
+        except (PictureDBError, IOError, OSError) as e:
+            logging.warning('Skipping the copies of “{}”: {}'.format(group[0], e))
+            return None
+
+    return images
+
+def merge_duplicate_tags(groups, index=None, iptc=False, jobs=1):
+    """
+    Gives every file of a group of duplicates the tags of all of them.
+
+    The tags are only changed in memory, the images that changed have to be
+    saved afterwards. Groups with a file that cannot be parsed or read are
+    skipped as a whole.
+
+    :param groups: Groups of paths from :py:func:`find_duplicates`.
+    :type groups: list
+    :param index: Metadata index to use.
+    :type index: MetadataIndex
+    :param iptc: Whether the IPTC keywords are merged as well.
+    :type iptc: bool
+    :param jobs: Number of threads to read the IPTC fields with.
+    :type jobs: int
+    :return: Images that got new tags.
+    :rtype: list
+    """
+    changed = []
+    for group in groups:
+        images = _load_duplicates(group, index, iptc, jobs)
+        if images is None:
+            continue
+
+        tags = set()
+        for image in images:
+            tags.update(image.get_tags())
+
+        for image in images:
+            missing = tags.difference(image.get_tags())
+            if len(missing) == 0:
+                continue
+            for tag in sorted(missing):
+                image.add_tag(tag)
+            changed.append(image)
+
+    return changed
+
+def sync_files(paths, iptc=False, jobs=1, journal=None, policy='bump', index=None):
+    """
+    Brings the names and, optionally, the IPTC keywords of the files in line.
+
+    This is what ``hashtag --iptc`` does without any tag changes. Paths that
+    do not exist any more or cannot be parsed are skipped.
+
+    :param paths: Files to check.
+    :type paths: list
+    :param iptc: Whether to sync the IPTC keywords with the names.
+    :type iptc: bool
+    :param jobs: Number of threads for the IPTC fields.
+    :type jobs: int
+    :param journal: Path of a journal for :py:func:`rename_files`.
+    :param policy: One of :py:data:`collision_policies`.
+    :param index: Metadata index to use.
+    :type index: MetadataIndex
+    :return: Images that have been saved.
+    :rtype: list
+    """
+    images = []
+    for path in paths:
+        if not _isfile(path):
+            continue
+        try:
+            images.append(Image(path, index))
+        except PictureDBError as e:
+            logging.warning('Skipping “{}”: {}'.format(path, e))
+
+    if iptc:
+        parallel_map(Image.load_iptc, images, jobs)
+        changed = [image for image in images
+                   if image.name_changed() or image.iptc_changed()]
+        batch_save(changed, jobs, journal, policy)
+    else:
+        changed = [image for image in images if image.name_changed()]
+        batch_rename(changed, journal, policy)
+
+    return changed
+
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_TO = 0x00000080
+_IN_CREATE = 0x00000100
+_IN_Q_OVERFLOW = 0x00004000
+_IN_IGNORED = 0x00008000
+_IN_ISDIR = 0x40000000
+_IN_CLOEXEC = 0o2000000
+
+_inotify_event = struct.Struct('iIII')
+
+_libc = None
+
+def _load_libc():
+    global _libc
+    if _libc is None:
+        name = ctypes.util.find_library('c')
+        libc = ctypes.CDLL(name, use_errno=True)
+        if not hasattr(libc, 'inotify_init1'):
+            raise PictureDBError('inotify is not available.')
+        libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        _libc = libc
+    return _libc
+
+class Watcher(object):
+    """
+    Watches a directory tree for new and changed files with inotify.
+
+    Every folder below the root gets a watch, new folders are added as they
+    appear. Files that are written, created or moved into the tree are
+    collected and handed out in batches once nothing happened for a while.
+    Hidden files are ignored, these are the temporary files of
+    :py:func:`rename_files` and :py:func:`write_iptc_keywords`.
+    """
+
+    def __init__(self, root, delay=2.0, max_delay=30.0):
+        """
+        Starts watching.
+
+        :param root: Directory to watch.
+        :param delay: Seconds without events after which a batch is done.
+        :type delay: float
+        :param max_delay: Seconds after which a batch is done in any case.
+        :type max_delay: float
+        :raises PictureDBError: Raised if inotify is not available.
+        """
+        self.root = root
+        self.delay = delay
+        self.max_delay = max_delay
+        self.libc = _load_libc()
+        self.fd = self.libc.inotify_init1(_IN_CLOEXEC)
+        if self.fd < 0:
+            raise PictureDBError('Cannot use inotify: {}'.format(
+                os.strerror(ctypes.get_errno())))
+        self.watches = {}
+        self.pending = set()
+        self._add_tree(root, False)
+
+    def close(self):
+        """
+        Stops watching.
+        """
+        os.close(self.fd)
+
+    def _add_tree(self, top, collect):
+        for dirpath, dirnames, filenames in os.walk(top):
+            dirnames[:] = sorted(name for name in dirnames if not name.startswith('.'))
+            wd = self.libc.inotify_add_watch(
+                self.fd, dirpath, _IN_CLOSE_WRITE | _IN_MOVED_TO | _IN_CREATE)
+            if wd < 0:
+                logging.warning('Cannot watch “{}”: {}'.format(
+                    dirpath, os.strerror(ctypes.get_errno())))
+                continue
+            self.watches[wd] = dirpath
+
+            # Files that arrived before the watch was set up.
+            if collect:
+                for name in filenames:
+                    if not name.startswith('.'):
+                        self.pending.add(os.path.join(dirpath, name))
+
+    def _read_events(self):
+        data = os.read(self.fd, 1 << 16)
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = _inotify_event.unpack_from(data, offset)
+            offset += _inotify_event.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+
+            if mask & _IN_Q_OVERFLOW:
+                logging.warning('Lost inotify events, rescanning “{}”.'.format(self.root))
+                self._add_tree(self.root, True)
+                continue
+            if mask & _IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+            if wd not in self.watches or name.startswith('.'):
+                continue
+
+            path = os.path.join(self.watches[wd], name)
+            if mask & _IN_ISDIR:
+                if mask & (_IN_CREATE | _IN_MOVED_TO):
+                    self._add_tree(path, True)
+            elif mask & (_IN_CLOSE_WRITE | _IN_MOVED_TO):
+                self.pending.add(path)
+
+    def batches(self):
+        """
+        Waits for changes and yields them in batches.
+
+        Files that are still being copied do not show up before they are
+        closed, so a camera import ends up in a few large batches.
+
+        :return: Generator of sorted lists of paths.
+        """
+        first = last = None
+        while True:
+            timeout = None
+            if len(self.pending) > 0:
+                now = time.time()
+                timeout = max(0, min(last + self.delay, first + self.max_delay) - now)
+
+            readable = select.select([self.fd], [], [], timeout)[0]
+
+            if len(readable) > 0:
+                had_pending = len(self.pending) > 0
+                self._read_events()
+                if len(self.pending) > 0:
+                    last = time.time()
+                    if not had_pending:
+                        first = last
+            elif len(self.pending) > 0:
+                batch = sorted(self.pending)
+                self.pending.clear()
+                yield batch
+
+service_socket = os.path.join(cache_dir, 'service.socket')
+"""
+Default location of the Unix socket of :py:class:`PictureService`.
+"""
+
+class PictureService(object):
+    """
+    Long-running service that keeps parsed images and the tags in memory.
+
+    Clients connect to a Unix socket and send one request per connection as
+    a line of JSON, the response is a line of JSON as well. A request has a
+    ``command``:
+
+    ``ping``
+        Checks that the service is running.
+    ``tag``
+        Adds the tags in ``add`` and removes the ones in ``remove`` from the
+        files and folders in ``paths``, then renames them and, if ``iptc`` is
+        set, writes their IPTC keywords. The response lists the ``changed``
+        files as pairs of old and new path.
+    ``tags``
+        Gives the ``tags`` that are known, the most used first.
+    ``shutdown``
+        Stops the service.
+
+    Images are kept between requests and only parsed again when their file
+    has changed on disk. Requests are handled one after the other, so they
+    cannot interfere with each other.
+    """
+
+    def __init__(self, path=None, index=None, max_images=100000, timeout=10.0,
+                 tag_index=None):
+        """
+        Creates the service, it starts with :py:meth:`serve`.
+
+        :param path: Path of the socket, defaults to
+            :py:data:`service_socket`.
+        :param index: Metadata index to use.
+        :type index: MetadataIndex
+        :param max_images: Number of images to keep in memory.
+        :type max_images: int
+        :param timeout: Seconds a client has to send its request and to
+            receive the response.
+        :type timeout: float
+        :param tag_index: Path of the :py:class:`TagIndex` with the known
+            tags, defaults to :py:data:`tag_index_file`.
+        """
+        if path is None:
+            path = service_socket
+        if tag_index is None:
+            tag_index = tag_index_file
+
+        self.path = path
+        self.index = index
+        self.max_images = max_images
+        self.timeout = timeout
+        self.journal = rename_journal_file
+        self.images = collections.OrderedDict()
+        self.vocabulary = collections.Counter()
+        self.running = False
+
+        if _isfile(tag_index):
+            for escaped, ids in TagIndex.load(tag_index).postings.items():
+                self.vocabulary[Tag.from_escaped(escaped)] += len(ids)
+
+    def _image(self, path):
+        """
+        Gives the image for the path, parsing it only if the file changed.
+        """
+        signature = MetadataIndex._signature(path)
+        if path in self.images:
+            image, known = self.images.pop(path)
+            if known == signature:
+                self.images[path] = (image, known)
+                return image
+
+        image = Image(path, self.index)
+        self._remember(image)
+        return image
+
+    def _remember(self, image):
+        self.images[image.origname] = (image, MetadataIndex._signature(image.origname))
+        while len(self.images) > self.max_images:
+            self.images.popitem(last=False)
+
+    def _image_changed(self, oldname, image):
+        self.images.pop(oldname, None)
+        self._remember(image)
+
+    def handle(self, request):
+        """
+        Answers a single request.
+
+        :param request: Decoded request.
+        :type request: dict
+        :return: Response.
+        :rtype: dict
+        """
+        command = request.get('command')
+        if command == 'ping':
+            return {'images': len(self.images)}
+        if command == 'tags':
+            return {'tags': [str(tag) for tag, count in self.vocabulary.most_common()]}
+        if command == 'shutdown':
+            self.running = False
+            return {}
+        if command == 'tag':
+            return self._tag(request)
+        raise PictureDBError('Unknown command “{}”.'.format(command))
+
+    def _tag(self, request):
+        paths = [os.path.abspath(path) for path in _native(request.get('paths', []))]
+        add = [Tag(text) for text in _native(request.get('add', []))]
+        remove = [Tag(text) for text in _native(request.get('remove', []))]
+        iptc = bool(request.get('iptc', False))
+        policy = str(request.get('collision', 'bump'))
+
+        images = []
+        for files in walk_albums(paths):
+            images.extend(self._image(path) for path in files)
+
+        transaction = TagTransaction(self.index)
+        for image in images:
+            for tag in add:
+                transaction.add(image, tag)
+            for tag in remove:
+                transaction.remove(image, tag)
+        changed = transaction.apply(iptc=iptc)
+
+        # Files that only need a new name are fixed as well.
+        for image in images:
+            if image not in changed and (image.name_changed() or (iptc and image.iptc_changed())):
+                changed.append(image)
+
+        oldnames = [image.origname for image in changed]
+        saved = False
+        try:
+            if iptc:
+                batch_save(changed, journal=self.journal, policy=policy)
+            else:
+                batch_rename(changed, self.journal, policy)
+            saved = True
+        finally:
+            # Images that were skipped or failed have tags in memory that
+            # their files do not have. They are parsed again next time.
+            for image in changed:
+                if not saved or image.name_changed():
+                    self.images.pop(image.origname, None)
+
+        self.vocabulary.update(add)
+
+        return {'changed': [[oldname, image.origname]
+                            for oldname, image in zip(oldnames, changed)
+                            if oldname != image.origname or iptc]}
+
+    def _handle_connection(self, connection):
+        f = connection.makefile('rb')
+        try:
+            line = f.readline()
+        finally:
+            f.close()
+
+        try:
+            response = self.handle(json.loads(line))
+        except (PictureDBError, ValueError, TypeError, AttributeError,
+                IOError, OSError) as e:
+            logging.warning('Request failed: {}'.format(e))
+            response = {'error': str(e)}
+
+        connection.sendall(json.dumps(response) + '\n')
+
+    def serve(self):
+        """
+        Answers requests until a ``shutdown`` request arrives.
+
+        :raises ServiceError: Raised if another service is running already.
+        """
+        try:
+            request_service({'command': 'ping'}, self.path)
+        except ServiceError:
+            if _exists(self.path):
+                os.remove(self.path)
+        else:
+            raise ServiceError('A service is running at “{}” already.'.format(self.path))
+
+        dirname = os.path.dirname(self.path)
+        if len(dirname) > 0 and not _isdir(dirname):
+            os.makedirs(dirname)
+
+        # The socket is created with the right permissions right away, other
+        # users must not be able to connect in between.
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        umask = os.umask(0o077)
+        try:
+            server.bind(self.path)
+        finally:
+            os.umask(umask)
+        server.listen(16)
+        change_listeners.append(self._image_changed)
+        self.running = True
+
+        try:
+            while self.running:
+                connection, address = server.accept()
+                # A client that does not send its request must not block
+                # everybody else.
+                connection.settimeout(self.timeout)
+                try:
+                    self._handle_connection(connection)
+                except socket.error as e:
+                    logging.warning('Request failed: {}'.format(e))
+                finally:
+                    connection.close()
+                if self.index is not None:
+                    self.index.commit()
+        finally:
+            change_listeners.remove(self._image_changed)
+            server.close()
+            os.remove(self.path)
+
+def request_service(request, path=None, timeout=None):
+    """
+    Sends a request to a running :py:class:`PictureService`.
+
+    :param request: Request with a ``command``.
+    :type request: dict
+    :param path: Path of the socket, defaults to :py:data:`service_socket`.
+    :param timeout: Seconds to wait for the answer, forever if ``None``.
+    :type timeout: float
+    :raises ServiceError: Raised if there is no service.
+    :raises PictureDBError: Raised if the request failed.
+    :return: Response.
+    :rtype: dict
+    """
+    if path is None:
+        path = service_socket
+
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        try:
+            client.connect(path)
+        except socket.error as e:
+            raise ServiceError('No service at “{}”: {}'.format(path, e))
+
+        client.settimeout(timeout)
+        client.sendall(json.dumps(request) + '\n')
+        f = client.makefile('rb')
+        try:
+            line = f.readline()
+        finally:
+            f.close()
+    finally:
+        client.close()
+
+    if len(line) == 0:
+        raise ServiceError('The service at “{}” did not answer.'.format(path))
+
+    response = _native(json.loads(line))
+    if 'error' in response:
+        raise PictureDBError(response['error'])
+    return response
+
+_photoshop_header = b'Photoshop 3.0\x00'
+_iptc_resource_id = 0x0404
+
+iptc_padding = 512
+"""
+Zero bytes reserved after the IPTC datasets whenever the APP13 segment has
+to be rebuilt, such that later changes to the keywords fit in place.
+"""
+
+def save_keywords(filename, keywords):
+    """
+    Writes the IPTC keywords of any file.
+
+    JPEG files are handled by :py:func:`write_iptc_keywords`, everything else
+    by ``iptcinfo``.
+
+    :param filename: Path of the file.
+    :param keywords: Keywords to store, replacing the present ones.
+    :type keywords: list
+    """
+    logging.info('Saving IPTC keywords to “{}”.'.format(filename))
+    stats.count('iptc writes')
+    with stats.timer('iptc write'):
+        try:
+            if write_iptc_keywords(filename, keywords):
+                stats.count('iptc writes in place')
+        except JPEGFormatError as e:
+            logging.info('Using iptcinfo for “{}”: {}'.format(filename, e))
+            iptc = IPTCInfo(filename, force=True)
+            iptc.data['keywords'] = keywords
+            iptc.save()
+
+def _jpeg_segments(read):
+    """
+    Walks the marker segments of a JPEG file up to the start of the scan.
+
+    :param read: Function that gives the bytes at an offset, called with the
+        offset and the number of bytes.
+    :raises JPEGFormatError: Raised if the file is not a JPEG or the markers
+        are malformed.
+    :return: Generator of tuples with the marker, the offset of the segment
+        and the offset after the segment. The payload starts four bytes after
+        the offset of the segment.
+    """
+    if read(0, 2) != b'\xff\xd8':
+        raise JPEGFormatError('File does not start with a JPEG marker.')
+
+    position = 2
+    while True:
+        header = read(position, 4)
+        if len(header) < 2 or header[0:1] != b'\xff':
+            raise JPEGFormatError('Expected a marker at {}.'.format(position))
+
+        marker = ord(header[1:2])
+        if marker == 0xff:
+            # Fill byte in front of a marker.
+            position += 1
+            continue
+        if marker == 0x01 or 0xd0 <= marker <= 0xd8:
+            # Markers without a payload.
+            position += 2
+            continue
+        if marker in (0xd9, 0xda):
+            return
+        if len(header) < 4:
+            raise JPEGFormatError('Truncated segment at {}.'.format(position))
+
+        length = struct.unpack('>H', header[2:4])[0]
+        if length < 2:
+            raise JPEGFormatError('Invalid segment length at {}.'.format(position))
+
+        yield marker, position, position + 2 + length
+        position += 2 + length
+
+def _parse_irb(data):
+    """
+    Parses the Photoshop image resource blocks of an APP13 segment.
+
+    :param data: Payload after the Photoshop header.
+    :raises JPEGFormatError: Raised if a block is truncated.
+    :return: Tuples with the resource ID, the raw name field, the offset of
+        the resource data and its length.
+    :rtype: list
+    """
+    resources = []
+    position = 0
+    while position + 12 <= len(data) and data[position:position + 4] == b'8BIM':
+        resource_id = struct.unpack('>H', data[position + 4:position + 6])[0]
+
+        # The name is a Pascal string, padded to an even length.
+        name_size = ord(data[position + 6:position + 7]) + 1
+        name_size += name_size % 2
+        name = data[position + 6:position + 6 + name_size]
+
+        size_position = position + 6 + name_size
+        size = struct.unpack('>I', data[size_position:size_position + 4])[0]
+        start = size_position + 4
+        if start + size > len(data):
+            raise JPEGFormatError('Truncated image resource block.')
+
+        resources.append((resource_id, name, start, size))
+        position = start + size + size % 2
+
+    return resources
+
+def _pack_irb(resources):
+    """
+    Packs Photoshop image resource blocks.
+
+    :param resources: Tuples with resource ID, raw name field and data.
+    :type resources: list
+    :rtype: bytes
+    """
+    parts = []
+    for resource_id, name, data in resources:
+        parts += [b'8BIM', struct.pack('>H', resource_id), name,
+                  struct.pack('>I', len(data)), data]
+        if len(data) % 2 == 1:
+            parts.append(b'\x00')
+    return b''.join(parts)
+
+def _parse_iptc(data):
+    """
+    Parses IPTC datasets up to the first byte that does not start one.
+
+    >>> _parse_iptc(b'\\x1c\\x02\\x19\\x00\\x03Foo\\x00\\x00')
+    [(2, 25, 'Foo')]
+
+    :param data: IPTC-NAA resource data.
+    :return: Tuples with record, dataset and value.
+    :rtype: list
+    """
+    datasets = []
+    position = 0
+    while position + 5 <= len(data) and data[position:position + 1] == b'\x1c':
+        record = ord(data[position + 1:position + 2])
+        dataset = ord(data[position + 2:position + 3])
+        length = struct.unpack('>H', data[position + 3:position + 5])[0]
+        position += 5
+
+        if length & 0x8000:
+            # Extended dataset, the length is stored in the next bytes.
+            count = length & 0x7fff
+            length = int(binascii.hexlify(data[position:position + count]) or b'0', 16)
+            position += count
+
+        datasets.append((record, dataset, data[position:position + length]))
+        position += length
+
+    return datasets
+
+def _pack_iptc(datasets):
+    """
+    Packs IPTC datasets.
+
+    :param datasets: Tuples with record, dataset and value.
+    :type datasets: list
+    :rtype: bytes
+    """
+    parts = []
+    for record, dataset, value in datasets:
+        if len(value) < 0x8000:
+            header = struct.pack('>BBBH', 0x1c, record, dataset, len(value))
+        else:
+            header = struct.pack('>BBBHI', 0x1c, record, dataset, 0x8004, len(value))
+        parts += [header, value]
+    return b''.join(parts)
+
+def _replace_keywords(datasets, keywords):
+    """
+    Replaces the keyword datasets (2:25), keeping the datasets ordered.
+
+    >>> _replace_keywords([(2, 0, 'v'), (2, 25, 'a'), (2, 80, 'b')], ['c'])
+    [(2, 0, 'v'), (2, 25, 'c'), (2, 80, 'b')]
+    """
+    others = [item for item in datasets if item[:2] != (2, 25)]
+    position = len(others)
+    for i, item in enumerate(others):
+        if item[:2] > (2, 25):
+            position = i
+            break
+
+    new = [(2, 25, keyword) for keyword in keywords]
+    return others[:position] + new + others[position:]
+
+def _fsync_directory(dirname):
+    fd = os.open(dirname, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def _replace_segment(filename, f, start, end, segment):
+    """
+    Writes a copy of the file with the bytes between start and end replaced,
+    then moves it over the original.
+
+    The copy is synced to disk before it replaces the original, so the file
+    is either the old or the new version even if the system crashes.
+    """
+    dirname = os.path.dirname(filename) or '.'
+    fd, temp = tempfile.mkstemp(
+        prefix='.{}.'.format(os.path.basename(filename)), dir=dirname)
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            f.seek(0)
+            remaining = start
+            while remaining > 0:
+                chunk = f.read(min(remaining, 1 << 20))
+                if len(chunk) == 0:
+                    raise JPEGFormatError('File shrunk while copying.')
+                out.write(chunk)
+                remaining -= len(chunk)
+
+            out.write(segment)
+
+            f.seek(end)
+            shutil.copyfileobj(f, out, 1 << 20)
+
+            out.flush()
+            os.fsync(out.fileno())
+
+        shutil.copymode(filename, temp)
+        os.rename(temp, filename)
+    except:
+        os.remove(temp)
+        raise
+
+    _fsync_directory(dirname)
+
+def write_iptc_keywords(filename, keywords):
+    """
+    Replaces the IPTC keywords of a JPEG file.
+
+    Only the marker headers are read, through a memory map. If the new
+    keywords fit into the space of the existing IPTC data, including the
+    zero padding after it, the bytes are patched in place. Otherwise the
+    APP13 segment is rebuilt with :py:data:`iptc_padding` spare bytes and the
+    file is copied once into a new file that atomically replaces the old one.
+    Other IPTC datasets and image resources are kept.
+
+    :param filename: Path to the JPEG file.
+    :param keywords: New keywords.
+    :type keywords: list
+    :raises JPEGFormatError: Raised if the file cannot be handled here.
+    :return: Whether the file was patched in place.
+    :rtype: bool
+    """
+    with open(filename, 'r+b') as f:
+        try:
+            data = mmap.mmap(f.fileno(), 0)
+        except ValueError as e:
+            raise JPEGFormatError('Cannot map “{}”: {}'.format(filename, e))
+
+        try:
+            read = lambda offset, count: data[offset:offset + count]
+
+            app13 = None
+            insert_at = 2
+            for marker, start, end in _jpeg_segments(read):
+                if end > len(data):
+                    raise JPEGFormatError('Truncated segment.')
+                if marker == 0xed and data[start + 4:start + 4 + len(_photoshop_header)] == _photoshop_header:
+                    if app13 is not None:
+                        raise JPEGFormatError('Multiple Photoshop segments.')
+                    app13 = (start, end)
+                if 0xe0 <= marker <= 0xef and insert_at == start:
+                    insert_at = end
+
+            resources = []
+            if app13 is not None:
+                irb_start = app13[0] + 4 + len(_photoshop_header)
+                irb = data[irb_start:app13[1]]
+                resources = _parse_irb(irb)
+
+            iptc = [resource for resource in resources if resource[0] == _iptc_resource_id]
+            if len(iptc) > 1:
+                raise JPEGFormatError('Multiple IPTC resources.')
+
+            datasets = []
+            if len(iptc) == 1:
+                resource_id, name, offset, size = iptc[0]
+                datasets = _parse_iptc(irb[offset:offset + size])
+
+            new_iptc = _pack_iptc(_replace_keywords(datasets, keywords))
+
+            if len(iptc) == 1 and len(new_iptc) <= size:
+                start = irb_start + offset
+                data[start:start + size] = new_iptc + b'\x00' * (size - len(new_iptc))
+                data.flush()
+                return True
+
+            new_iptc += b'\x00' * iptc_padding
+            new_resources = [(resource_id, name, irb[offset:offset + size])
+                             for resource_id, name, offset, size in resources
+                             if resource_id != _iptc_resource_id]
+            new_resources.append((_iptc_resource_id, b'\x00\x00', new_iptc))
+            payload = _photoshop_header + _pack_irb(new_resources)
+            if len(payload) + 2 > 0xffff:
+                raise JPEGFormatError('APP13 segment would be too large.')
+
+            segment = b'\xff\xed' + struct.pack('>H', len(payload) + 2) + payload
+            if app13 is None:
+                start, end = insert_at, insert_at
+            else:
+                start, end = app13
+        finally:
+            data.close()
+
+        _replace_segment(filename, f, start, end, segment)
+        return False
+
+header_read_size = 16384
+"""
+Number of bytes read at once from the start of a file when looking for
+metadata. Segments beyond that are read with a separate seek.
+"""
+
+class _HeaderReader(object):
+    """
+    Reads from a file, keeping the first bytes in memory.
+    """
+
+    def __init__(self, f, size=None):
+        if size is None:
+            size = header_read_size
+        self.f = f
+        self.head = f.read(size)
+        stats.count('bytes read', len(self.head))
+
+    def read(self, offset, count):
+        if offset + count <= len(self.head):
+            return self.head[offset:offset + count]
+        self.f.seek(offset)
+        data = self.f.read(count)
+        stats.count('bytes read', len(data))
+        return data
+
+def _find_iptc(read):
+    """
+    Finds the IPTC data in the first Photoshop APP13 segment.
+
+    :param read: Function that gives the bytes at an offset.
+    :return: IPTC-NAA resource data or ``None``.
+    """
+    for marker, start, end in _jpeg_segments(read):
+        if marker != 0xed:
+            continue
+
+        payload = read(start + 4, end - start - 4)
+        if not payload.startswith(_photoshop_header):
+            continue
+
+        irb = payload[len(_photoshop_header):]
+        for resource_id, name, offset, size in _parse_irb(irb):
+            if resource_id == _iptc_resource_id:
+                return irb[offset:offset + size]
+        return None
+
+    return None
+
+def read_iptc_keywords(filename):
+    """
+    Reads the IPTC keywords of a JPEG file.
+
+    Only the marker headers are looked at, the scan stops at the first
+    Photoshop APP13 segment or at the start of the image data. For most files
+    this is a single read of :py:data:`header_read_size` bytes.
+
+    :param filename: Path to the JPEG file.
+    :raises JPEGFormatError: Raised if the file is not a JPEG or malformed.
+    :return: Keywords, empty if there is no IPTC data.
+    :rtype: list
+    """
+    with open(filename, 'rb') as f:
+        reader = _HeaderReader(f)
+        data = _find_iptc(reader.read)
+
+    if data is None:
+        return []
+
+    return [value for record, dataset, value in _parse_iptc(data)
+            if (record, dataset) == (2, 25)]
+
+_exif_header = b'Exif\x00\x00'
+
+def _find_exif(read):
+    """
+    Finds the TIFF structure in the first Exif APP1 segment.
+
+    :param read: Function that gives the bytes at an offset.
+    :return: TIFF data or ``None``.
+    """
+    for marker, start, end in _jpeg_segments(read):
+        if marker != 0xe1:
+            continue
+
+        payload = read(start + 4, end - start - 4)
+        if payload.startswith(_exif_header):
+            return payload[len(_exif_header):]
+
+    return None
+
+def _tiff_byte_order(tiff):
+    if tiff[:4] == b'II*\x00':
+        return '<'
+    if tiff[:4] == b'MM\x00*':
+        return '>'
+    raise JPEGFormatError('Invalid TIFF header in the Exif data.')
+
+def _read_ifd(tiff, offset, order):
+    """
+    Reads an image file directory from TIFF data.
+
+    :param tiff: TIFF data.
+    :param offset: Offset of the directory.
+    :type offset: int
+    :param order: Byte order for :py:mod:`struct`.
+    :raises JPEGFormatError: Raised if the directory is not within the data.
+    :return: Tuple with a dict that maps the tag to the type, the count and
+        the four bytes of the value, and the offset of the next directory,
+        which is ``0`` for the last one.
+    :rtype: tuple
+    """
+    if offset < 8 or offset + 2 > len(tiff):
+        raise JPEGFormatError('IFD at {} is outside of the Exif data.'.format(offset))
+
+    count = struct.unpack(order + 'H', tiff[offset:offset + 2])[0]
+    end = offset + 2 + 12 * count
+    if end + 4 > len(tiff):
+        raise JPEGFormatError('Truncated IFD at {}.'.format(offset))
+
+    entries = {}
+    for position in range(offset + 2, end, 12):
+        tag, type_, number = struct.unpack(order + 'HHI', tiff[position:position + 8])
+        entries[tag] = (type_, number, tiff[position + 8:position + 12])
+
+    next_offset = struct.unpack(order + 'I', tiff[end:end + 4])[0]
+    return entries, next_offset
+
+def _ifd_integer(entry, order):
+    type_, number, value = entry
+    if type_ == 3:
+        return struct.unpack(order + 'H', value[:2])[0]
+    if type_ == 4:
+        return struct.unpack(order + 'I', value)[0]
+    raise JPEGFormatError('Expected an integer, got type {}.'.format(type_))
+
+def read_exif_thumbnail(filename):
+    """
+    Reads the thumbnail that cameras embed into the Exif data of a JPEG file.
+
+    Like :py:func:`read_iptc_keywords`, only the headers are read and nothing
+    is decoded.
+
+    :param filename: Path to the JPEG file.
+    :raises JPEGFormatError: Raised if the file is not a JPEG or malformed.
+    :return: JPEG data of the thumbnail or ``None`` if there is none.
+    :rtype: str
+    """
+    with open(filename, 'rb') as f:
+        reader = _HeaderReader(f)
+        tiff = _find_exif(reader.read)
+
+    if tiff is None:
+        return None
+
+    order = _tiff_byte_order(tiff)
+    ifd0, offset = _read_ifd(tiff, struct.unpack(order + 'I', tiff[4:8])[0], order)
+    if offset == 0:
+        return None
+
+    # The second directory describes the thumbnail.
+    ifd1, offset = _read_ifd(tiff, offset, order)
+    if 0x0201 not in ifd1 or 0x0202 not in ifd1:
+        return None
+
+    start = _ifd_integer(ifd1[0x0201], order)
+    length = _ifd_integer(ifd1[0x0202], order)
+    thumbnail = tiff[start:start + length]
+    if len(thumbnail) != length or not thumbnail.startswith(b'\xff\xd8'):
+        raise JPEGFormatError('Invalid thumbnail in the Exif data.')
+
+    return thumbnail
+
+def _ifd_ascii(tiff, entry, order):
+    type_, number, value = entry
+    if type_ != 2:
+        raise JPEGFormatError('Expected a string, got type {}.'.format(type_))
+    if number > 4:
+        start = struct.unpack(order + 'I', value)[0]
+        value = tiff[start:start + number]
+    return value[:number].rstrip(b'\x00')
+
+def read_exif_date(filename):
+    """
+    Reads the date a picture was taken from the Exif data of a JPEG file.
+
+    The ``DateTimeOriginal`` field is used, falling back to
+    ``DateTimeDigitized`` and the ``DateTime`` of the first directory. Like
+    :py:func:`read_iptc_keywords`, only the headers are read.
+
+    :param filename: Path to the JPEG file.
+    :raises JPEGFormatError: Raised if the file is not a JPEG or malformed.
+    :return: Date like ``20120204`` or ``None`` if there is none.
+    :rtype: str
+    """
+    with open(filename, 'rb') as f:
+        reader = _HeaderReader(f)
+        tiff = _find_exif(reader.read)
+
+    if tiff is None:
+        return None
+
+    order = _tiff_byte_order(tiff)
+    ifd0, offset = _read_ifd(tiff, struct.unpack(order + 'I', tiff[4:8])[0], order)
+
+    candidates = []
+    if 0x8769 in ifd0:
+        exif_ifd, offset = _read_ifd(tiff, _ifd_integer(ifd0[0x8769], order), order)
+        candidates += [exif_ifd.get(0x9003), exif_ifd.get(0x9004)]
+    candidates.append(ifd0.get(0x0132))
+
+    for entry in candidates:
+        if entry is None:
+            continue
+        m = _exif_date_pattern.match(_ifd_ascii(tiff, entry, order))
+        if m is not None and _is_date(''.join(m.groups())):
+            return ''.join(m.groups())
+
+    return None
+
+class ThumbnailCache(object):
+    """
+    Cache of Exif thumbnails on disk that drops the least recently used ones.
+
+    The entries are keyed by inode and modification time, so they survive
+    renames. Files without a thumbnail get an empty entry such that they are
+    not read again. Every entry counts with at least 4 KiB towards the size,
+    the usual block size of a file system.
+
+    The cache can be shared between threads.
+    """
+
+    def __init__(self, directory=None, max_size=64 << 20):
+        """
+        Opens the cache, creating the directory if needed.
+
+        :param directory: Directory with the thumbnails, defaults to
+            ``thumbnails`` in :py:data:`cache_dir`.
+        :param max_size: Size in bytes up to which thumbnails are kept.
+        :type max_size: int
+        """
+        if directory is None:
+            directory = os.path.join(cache_dir, 'thumbnails')
+
+        if not _isdir(directory):
+            os.makedirs(directory)
+
+        self.directory = directory
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+        self.size = 0
+
+        listing = []
+        for name in os.listdir(directory):
+            if name.startswith('.'):
+                continue
+            stat = _stat(os.path.join(directory, name))
+            listing.append((stat.st_mtime, name, stat.st_size))
+
+        for mtime, name, size in sorted(listing):
+            self.entries[name] = max(size, 4096)
+            self.size += self.entries[name]
+
+    def get(self, path):
+        """
+        Gives the thumbnail of a file, reading it if it is not cached.
+
+        :param path: Path to the image.
+        :return: JPEG data of the thumbnail or ``None`` if there is none.
+        :rtype: str
+        """
+        signature = MetadataIndex._signature(path)
+        if signature is None:
+            return None
+
+        size, mtime_ns, inode = signature
+        name = '{}-{}.jpg'.format(inode, mtime_ns)
+        cached = os.path.join(self.directory, name)
+
+        with self.lock:
+            hit = name in self.entries
+            if hit:
+                self.entries[name] = self.entries.pop(name)
+
+        if hit:
+            try:
+                with open(cached, 'rb') as f:
+                    data = f.read()
+                os.utime(cached, None)
+                stats.count('thumbnail cache hits')
+                return data or None
+            except (IOError, OSError):
+                pass
+
+        stats.count('thumbnail cache misses')
+        try:
+            data = read_exif_thumbnail(path)
+        except (JPEGFormatError, IOError) as e:
+            logging.info('No thumbnail in “{}”: {}'.format(path, e))
+            data = None
+
+        self._store(name, data or b'')
+        return data
+
+    def _store(self, name, data):
+        fd, temp = tempfile.mkstemp(prefix='.', dir=self.directory)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.rename(temp, os.path.join(self.directory, name))
+
+        with self.lock:
+            if name in self.entries:
+                self.size -= self.entries.pop(name)
+            self.entries[name] = max(len(data), 4096)
+            self.size += self.entries[name]
+
+            while self.size > self.max_size and len(self.entries) > 1:
+                old, size = self.entries.popitem(last=False)
+                self.size -= size
+                try:
+                    os.remove(os.path.join(self.directory, old))
+                except OSError:
+                    pass
@@ -0,0 +1,270 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright © 2013 Martin Ueding <dev@martin-ueding.de>
+
+"""
+Benchmarks for the ``picturedb`` module.
+
+A synthetic picture archive is generated and every stage of a ``hashtag`` run
+is timed on it. Run it with ``make benchmark`` or directly::
+
+    python picturedb_benchmark.py -n 100k --json new.json --compare old.json
+
+:see: picturedb
+"""
+
+import argparse
+import collections
+import itertools
+import json
+import os.path
+import platform
+import shutil
+import tempfile
+import time
+
+import picturedb
+
+__docformat__ = "restructuredtext en"
+
+def synthetic_names(count):
+    """
+    Generates a mix of canonical and camera filenames in album folders.
+
+    >>> synthetic_names(2)
+    ['20120204-Event-0/20120204-Event-0-0#Martin_Ueding.jpg', '20120204-Event-0/IMG_0001.jpg']
+
+    :param count: Number of names.
+    :type count: int
+    :return: List with paths.
+    :rtype: list
+    """
+    tags = ['#Martin_Ueding', '#Another_Tag#Martin_Ueding', '']
+    names = []
+    for n in range(count):
+        album = '20120204-Event-{}'.format(n // 1000)
+        if n % 2 == 0:
+            names.append('{0}/{0}-{1}{2}.jpg'.format(album, n, tags[n % 3]))
+        else:
+            names.append('{}/IMG_{:04d}.jpg'.format(album, n))
+    return names
+
+def benchmark_parse(names, repeat=3):
+    """
+    Measures how fast filenames can be parsed and formatted.
+
+    For each name, an :py:class:`picturedb.Image` is created and its
+    :py:meth:`picturedb.Image.current_path` and
+    :py:meth:`picturedb.Image.name_changed` are called, like ``hashtag``
+    does.
+
+    :param names: Paths to parse.
+    :type names: list
+    :param repeat: Number of runs, the fastest counts.
+    :type repeat: int
+    :return: Images per second.
+    :rtype: float
+    """
+    best = None
+    for run in range(repeat):
+        start = time.time()
+        for name in names:
+            image = picturedb.Image(name)
+            image.current_path()
+            image.name_changed()
+        duration = time.time() - start
+        if best is None or duration < best:
+            best = duration
+
+    return len(names) / best
+
+def parse_scale(text):
+    """
+    Parses a number of images with an optional ``k`` or ``M`` suffix.
+
+    >>> parse_scale('1k'), parse_scale('1M'), parse_scale('250')
+    (1000, 1000000, 250)
+
+    :param text: Number like ``100k``.
+    :type text: str
+    :rtype: int
+    """
+    factors = {'k': 10**3, 'M': 10**6}
+    if len(text) > 0 and text[-1] in factors:
+        return int(text[:-1]) * factors[text[-1]]
+    return int(text)
+
+minimal_jpeg = (
+    b'\xff\xd8'
+    b'\xff\xe0\x00\x10JFIF\x00\x01\x01\x00\x00\x01\x00\x01\x00\x00'
+    b'\xff\xc0\x00\x0b\x08\x00\x01\x00\x01\x01\x01\x11\x00'
+    b'\xff\xda\x00\x08\x01\x01\x00\x00\x3f\x00\x00'
+    b'\xff\xd9'
+)
+"""
+Smallest file with the marker structure of a JPEG, with a 1×1 gray image.
+"""
+
+def _jpeg_with_keywords(keywords, cache):
+    key = tuple(keywords)
+    if key not in cache:
+        fd, path = tempfile.mkstemp(suffix='.jpg')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(minimal_jpeg)
+            picturedb.write_iptc_keywords(path, keywords)
+            with open(path, 'rb') as f:
+                cache[key] = f.read()
+        finally:
+            os.remove(path)
+    return cache[key]
+
+def build_archive(root, count):
+    """
+    Creates an archive with small JPEG files in album folders.
+
+    The files are named like :py:func:`synthetic_names`. Every file carries
+    IPTC keywords, the canonical names have the same ones as hashtags.
+
+    :param root: Directory to create the albums in.
+    :param count: Number of files.
+    :type count: int
+    """
+    contents = {}
+    for n, name in enumerate(synthetic_names(count)):
+        if n % 2 == 0:
+            keywords = [str(tag) for tag in sorted(picturedb.Image(name).tags)]
+        else:
+            keywords = ['Martin Ueding']
+
+        path = os.path.join(root, name)
+        dirname = os.path.dirname(path)
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        with open(path, 'wb') as f:
+            f.write(_jpeg_with_keywords(keywords, contents))
+
+def benchmark_archive(root, jobs=1):
+    """
+    Times the stages of a ``hashtag --iptc -c`` run on an archive.
+
+    The files are renamed back afterwards, so the archive can be used again.
+
+    :param root: Directory with the albums.
+    :param jobs: Number of threads for the IPTC fields.
+    :type jobs: int
+    :return: Seconds per stage, in the order they ran.
+    :rtype: collections.OrderedDict
+    """
+    timings = collections.OrderedDict()
+
+    def timed(stage, function, *args):
+        start = time.time()
+        result = function(*args)
+        timings[stage] = time.time() - start
+        return result
+
+    albums = timed('walk', lambda: list(picturedb.walk_albums([root])))
+    albums = timed('parse', lambda: [[picturedb.Image(name) for name in files]
+                                     for files in albums])
+    images = list(itertools.chain.from_iterable(albums))
+    timed('iptc', picturedb.parallel_map, picturedb.Image.load_iptc, images, jobs)
+    timed('compress', lambda: [picturedb.compress_numbers(album) for album in albums])
+    renamed = timed('plan', lambda: [picturedb.plan_renames(album) for album in albums])
+
+    moves = [(image.current_path(), image.origname)
+             for album in renamed for image in album]
+    journal = os.path.join(tempfile.gettempdir(), 'pdb-benchmark-{}.journal'.format(os.getpid()))
+    timed('rename', lambda: [picturedb.batch_rename(album, journal) for album in renamed])
+    picturedb.rename_files(moves)
+
+    index = timed('index', picturedb.TagIndex.build, [root])
+    timed('query', lambda: [index.query(['Martin_Ueding', 'and', 'not', 'Another_Tag'])
+                            for run in range(100)])
+
+    return timings
+
+def compare(old, new):
+    """
+    Formats the change of every stage between two results.
+
+    >>> print compare({'stages': {'walk': 2.0}}, {'stages': {'walk': 1.0}})
+    walk            2.000 s      1.000 s   0.50×
+
+    :param old: Results of the earlier run.
+    :type old: dict
+    :param new: Results of this run.
+    :type new: dict
+    :rtype: str
+    """
+    lines = []
+    for stage, seconds in new['stages'].items():
+        if stage not in old['stages']:
+            continue
+        before = old['stages'][stage]
+        ratio = seconds / before if before > 0 else float('inf')
+        lines.append('{:10} {:10.3f} s {:10.3f} s {:6.2f}×'.format(stage, before, seconds, ratio))
+    return '\n'.join(lines)
+
+def main():
+    options = _parse_args()
+
+    names = synthetic_names(options.n)
+    rate = benchmark_parse(names, options.repeat)
+    print 'parse names: {:.0f} images/s'.format(rate)
+
+    root = options.dir
+    if root is None:
+        root = tempfile.mkdtemp(prefix='pdb-benchmark-')
+    try:
+        if not os.path.isdir(root) or len(os.listdir(root)) == 0:
+            start = time.time()
+            build_archive(root, options.n)
+            print 'build archive: {:.3f} s'.format(time.time() - start)
+
+        timings = benchmark_archive(root, options.jobs)
+    finally:
+        if options.dir is None:
+            shutil.rmtree(root)
+
+    for stage, seconds in timings.items():
+        print '{}: {:.3f} s, {:.0f} images/s'.format(stage, seconds, options.n / max(seconds, 1e-9))
+
+    results = {
+        'count': options.n,
+        'jobs': options.jobs,
+        'python': platform.python_version(),
+        'parse_rate': rate,
+        'stages': timings,
+    }
+
+    if options.json is not None:
+        with open(options.json, 'w') as f:
+            json.dump(results, f, indent=4)
+
+    if options.compare is not None:
+        with open(options.compare) as f:
+            old = json.load(f, object_pairs_hook=collections.OrderedDict)
+        print
+        print compare(old, results)
+
+def _parse_args():
+    """
+    Parses the command line arguments.
+
+    :return: Namespace with arguments.
+    :rtype: Namespace
+    """
+    parser = argparse.ArgumentParser(description="Benchmarks for picturedb.")
+    parser.add_argument('-n', type=parse_scale, default='10k', help='Number of images, like 1k, 100k or 1M. Default: %(default)s')
+    parser.add_argument('--repeat', type=int, default=3, help='Number of runs of the name parsing, the fastest counts. Default: %(default)s')
+    parser.add_argument('--dir', help='Keep the archive in this directory and use it again in later runs. Default: a temporary directory.')
+    parser.add_argument('-j', '--jobs', metavar='N', type=int, default=1, help='Read IPTC fields with N threads. Default: %(default)s')
+    parser.add_argument('--json', metavar='file', help='Write the results to this file.')
+    parser.add_argument('--compare', metavar='file', help='Compare with the results in this file.')
+
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    main()
@@ -9,12 +9,61 @@ Tests for the ``picturedb`` module.
 :see: picturedb
 """
 
+import fcntl
+import json
+import os
+import random
+import shutil
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
 import unittest
 
 from picturedb import *
+from picturedb_benchmark import minimal_jpeg
 
 __docformat__ = "restructuredtext en"
 
+def exif_jpeg(thumbnail=None, date=None):
+    """
+    Gives :py:data:`minimal_jpeg` with an Exif segment that only contains the
+    thumbnail and the date the picture was taken.
+    """
+    ifd0_offset = 8
+    exif_offset = ifd0_offset + 18
+    date_offset = exif_offset + 18
+    ifd1_offset = date_offset + 20
+    thumbnail_offset = ifd1_offset + 30
+
+    tiff = b'II*\x00' + struct.pack('<I', ifd0_offset)
+    tiff += struct.pack('<HHHII', 1, 0x8769, 4, 1, exif_offset)
+    tiff += struct.pack('<I', ifd1_offset if thumbnail is not None else 0)
+    tiff += struct.pack('<HHHII', 1, 0x9003, 2, 20, date_offset) + struct.pack('<I', 0)
+    tiff += (date or '0000:00:00 00:00:00').ljust(19) + b'\x00'
+    if thumbnail is not None:
+        tiff += struct.pack('<H', 2)
+        tiff += struct.pack('<HHII', 0x0201, 4, 1, thumbnail_offset)
+        tiff += struct.pack('<HHII', 0x0202, 4, 1, len(thumbnail))
+        tiff += struct.pack('<I', 0) + thumbnail
+
+    payload = b'Exif\x00\x00' + tiff
+    return minimal_jpeg[:2] + b'\xff\xe1' + struct.pack('>H', len(payload) + 2) + payload + minimal_jpeg[2:]
+
+def parse_deferred(shard):
+    """
+    Parses an image with a deferred index, like ``hashtag --processes`` does
+    in its workers.
+    """
+    path, filename = shard
+    index = MetadataIndex(filename, deferred=True)
+    Image(path, index).load_iptc()
+    pending = index.take_pending()
+    index.close()
+    return pending
+
 class ParseFilenameTest(unittest.TestCase):
     def test_without_folder(self):
         image = Image("20120204-Klopapierberg-9240#Martin_Ueding.jpg")
@@ -91,6 +140,16 @@ class GenerateFilenameTest(unittest.TestCase):
         image = Image('20120204-Klopapierberg/00000000-Foo-9240.jpg')
         self.assertEqual(image.current_path(), '20120204-Klopapierberg/20120204-Klopapierberg-9240.jpg')
 
+    def test_cache_invalidation(self):
+        image = Image('20120204-Klopapierberg-9240.jpg')
+        self.assertEqual(image.current_path(), '20120204-Klopapierberg-9240.jpg')
+        image.number = '1'
+        self.assertEqual(image.current_path(), '20120204-Klopapierberg-1.jpg')
+        image.add_tag(Tag('Foo'))
+        self.assertEqual(image.current_path(), '20120204-Klopapierberg-1#Foo.jpg')
+        image.remove_tag(Tag('Foo'))
+        self.assertEqual(image.current_path(), '20120204-Klopapierberg-1.jpg')
+
 
 class AddTagTest(unittest.TestCase):
     def test_currentpath(self):
@@ -108,3 +167,871 @@ class AddTagTest(unittest.TestCase):
         image.remove_tag(Tag('Foobar'))
         image.add_tag(Tag('Another Tag'))
         self.assertEqual(image.current_path(), '20120204-Klopapierberg-9240#Another_Tag.jpg')
+
+
+class LazyIPTCTest(unittest.TestCase):
+    def test_not_loaded(self):
+        image = Image('20120204-Klopapierberg-9240#Foobar.jpg')
+        self.assertIsNone(image.keywords)
+
+    def test_get_tags_with_iptc(self):
+        image = Image('20120204-Klopapierberg-9240#Foobar.jpg')
+        self.assertEqual(image.get_tags(iptc=True), [Tag('Foobar')])
+        self.assertEqual(image.keywords, [])
+
+
+class MetadataIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.index = MetadataIndex(os.path.join(self.tempdir, 'index.sqlite'))
+        self.album = os.path.join(self.tempdir, '20120204-Klopapierberg')
+        os.mkdir(self.album)
+        self.path = os.path.join(self.album, '20120204-Klopapierberg-9240#Martin_Ueding.jpg')
+        open(self.path, 'w').close()
+
+    def tearDown(self):
+        self.index.close()
+        shutil.rmtree(self.tempdir)
+
+    def test_hydrate(self):
+        Image(self.path, self.index)
+        entry = self.index.lookup(self.path)
+        self.assertEqual(entry.tags, ['Martin Ueding'])
+        self.assertIsNone(entry.keywords)
+
+        image = Image(self.path, self.index)
+        self.assertEqual(image.date, '20120204')
+        self.assertEqual(image.event, 'Klopapierberg')
+        self.assertEqual(image.number, '9240')
+        self.assertEqual(image.suffix, 'jpg')
+        self.assertEqual(image.tags, set([Tag('Martin Ueding')]))
+
+    def test_keywords(self):
+        Image(self.path, self.index).load_iptc()
+        self.assertEqual(self.index.lookup(self.path).keywords, [])
+
+    def test_stale(self):
+        Image(self.path, self.index)
+        with open(self.path, 'w') as f:
+            f.write('changed')
+        self.assertIsNone(self.index.lookup(self.path))
+
+    def test_rename(self):
+        image = Image(self.path, self.index)
+        image.add_tag(Tag('John Doe'))
+        image.rename()
+        self.assertIsNone(self.index.lookup(self.path))
+        entry = self.index.lookup(image.current_path())
+        self.assertEqual(entry.tags, ['John Doe', 'Martin Ueding'])
+
+    def test_deferred_processes(self):
+        paths = [self.path]
+        for number in range(1, 9):
+            paths.append(os.path.join(self.album, '20120204-Klopapierberg-{}.jpg'.format(number)))
+            open(paths[-1], 'w').close()
+
+        shards = [(path, self.index.filename) for path in paths]
+        for pending in process_map(parse_deferred, shards, 2):
+            self.index.write(pending)
+
+        for path in paths:
+            self.assertIsNotNone(self.index.lookup(path))
+
+
+class ParallelMapTest(unittest.TestCase):
+    def test_order(self):
+        items = list(range(100))
+        self.assertEqual(parallel_map(lambda x: x * x, items, 8), [x * x for x in items])
+
+    def test_processes(self):
+        items = list(range(-50, 50))
+        self.assertEqual(list(process_map(abs, iter(items), 3)), [abs(x) for x in items])
+
+
+class WalkAlbumsTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        for path in ['a/1.jpg', 'a/2.JPG', 'a/2.jpg~', 'a/3.png', 'a/b/1.jpg', 'c/1.jpg']:
+            path = os.path.join(self.tempdir, path)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            open(path, 'w').close()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def relative(self, batches):
+        return [[os.path.relpath(path, self.tempdir) for path in batch] for batch in batches]
+
+    def test_order(self):
+        batches = walk_albums([self.tempdir, os.path.join(self.tempdir, 'c/1.jpg')])
+        self.assertEqual(self.relative(batches), [
+            ['c/1.jpg'], ['a/1.jpg', 'a/2.JPG', 'a/3.png'], ['a/b/1.jpg'], ['c/1.jpg'],
+        ])
+
+    def test_filter(self):
+        batches = walk_albums([os.path.join(self.tempdir, 'a')], backups=True)
+        self.assertEqual(self.relative(batches), [
+            ['a/1.jpg', 'a/2.JPG', 'a/2.jpg~', 'a/3.png'], ['a/b/1.jpg'],
+        ])
+        batches = walk_albums([os.path.join(self.tempdir, 'a')], include=['jpg'])
+        self.assertEqual(self.relative(batches), [['a/1.jpg', 'a/2.JPG'], ['a/b/1.jpg']])
+        batches = walk_albums([os.path.join(self.tempdir, 'a')], exclude=['png'])
+        self.assertEqual(self.relative(batches), [['a/1.jpg', 'a/2.JPG'], ['a/b/1.jpg']])
+
+
+class SyncSymlinksTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.album = os.path.join(self.tempdir, '20120204-Klopapierberg')
+        os.mkdir(self.album)
+        for name in ['20120204-Klopapierberg-1#Ann.jpg', '20120204-Klopapierberg-2#Anna.jpg']:
+            open(os.path.join(self.album, name), 'w').close()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_sync(self):
+        tag_map = build_tag_map([self.tempdir], [Tag('Ann')])
+        self.assertEqual(tag_map, {Tag('Ann'): [os.path.join(self.album, '20120204-Klopapierberg-1#Ann.jpg')]})
+
+        links = os.path.join(self.tempdir, 'links')
+        self.assertEqual(sync_symlinks(links, tag_map[Tag('Ann')]), (['20120204-Klopapierberg-1#Ann.jpg'], []))
+        self.assertTrue(os.path.isfile(os.path.join(links, '20120204-Klopapierberg-1#Ann.jpg')))
+        self.assertEqual(sync_symlinks(links, tag_map[Tag('Ann')]), ([], []))
+        self.assertEqual(sync_symlinks(links, []), ([], ['20120204-Klopapierberg-1#Ann.jpg']))
+
+
+class TagIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_save_and_replay(self):
+        index = TagIndex()
+        index.add('/a.jpg', set([Tag('Ann')]))
+        index.add('/b.jpg', set([Tag('Anna')]))
+        filename = os.path.join(self.tempdir, 'tags.index')
+        index.save(filename)
+
+        journal = TagJournal(filename + '.journal')
+        image = Image('20120204-Klopapierberg-1#Anna.jpg')
+        image.origname = '/c.jpg'
+        journal('/a.jpg', image)
+
+        index = TagIndex.load(filename)
+        self.assertEqual(index.replay(filename + '.journal'), 1)
+        self.assertEqual(index.query(['Anna']), ['/b.jpg', '/c.jpg'])
+        self.assertEqual(index.query(['not', 'Anna']), [])
+        with self.assertRaises(QueryParseError):
+            index.query(['(Anna'])
+
+
+class CompactTest(unittest.TestCase):
+    def test_interned_tags(self):
+        first = Image('20120204-Klopapierberg-1#Martin_Ueding.jpg')
+        second = Image('20120204-Klopapierberg-2#Martin_Ueding.jpg')
+        self.assertIs(first.get_tags()[0], second.get_tags()[0])
+        self.assertIs(Tag('Martin Ueding'), first.get_tags()[0])
+
+    def test_slots(self):
+        image = Image('20120204-Klopapierberg-1.jpg')
+        with self.assertRaises(AttributeError):
+            image.foo = 'bar'
+
+
+class MinimalCompressTest(unittest.TestCase):
+    def compress(self, numbers):
+        images = [Image('20120204-Klopapierberg-{}.jpg'.format(number)) for number in numbers]
+        compress_numbers(images, minimal=True)
+        return [image.number for image in images]
+
+    def test_removed(self):
+        numbers = ['{:02d}'.format(n) for n in range(1, 21) if n != 3]
+        self.assertEqual(self.compress(numbers), numbers)
+
+    def test_wide(self):
+        self.assertEqual(self.compress(['001', '002', '007']), ['001', '002', '007'])
+
+    def test_growing(self):
+        numbers = ['{:02d}'.format(n) for n in range(1, 100)] + ['IMG']
+        self.assertEqual(self.compress(numbers), ['{:03d}'.format(n) for n in range(1, 101)])
+
+    def test_random(self):
+        generator = random.Random(1)
+        for run in range(200):
+            numbers = [str(generator.randint(0, 30)) for n in range(generator.randint(1, 12))]
+            result = self.compress(numbers)
+            self.assertEqual(len(set(len(number) for number in result)), 1)
+            self.assertEqual(sorted(set(result)), result)
+            self.assertGreater(int(result[0]), 0)
+
+            # Never more renames than numbering from one.
+            images = [Image('20120204-Klopapierberg-{}.jpg'.format(number)) for number in numbers]
+            compress_numbers(images)
+            plain = [image.number for image in images]
+            self.assertGreaterEqual(sum(a == b for a, b in zip(numbers, result)),
+                                    sum(a == b for a, b in zip(numbers, plain)))
+
+
+class BatchRenameTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.journal = os.path.join(self.tempdir, 'rename.journal')
+        self.album = os.path.join(self.tempdir, '20120204-Klopapierberg')
+        os.mkdir(self.album)
+        for number in range(3):
+            with open(os.path.join(self.album, '20120204-Klopapierberg-{}.jpg'.format(number)), 'w') as f:
+                f.write(str(number))
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def contents(self):
+        result = {}
+        for name in os.listdir(self.album):
+            with open(os.path.join(self.album, name)) as f:
+                result[name] = f.read()
+        return result
+
+    def test_shift(self):
+        images = [Image(os.path.join(self.album, name)) for name in sorted(os.listdir(self.album))]
+        compress_numbers(images)
+        batch_rename(images, self.journal)
+        self.assertEqual(self.contents(), {
+            '20120204-Klopapierberg-1.jpg': '0',
+            '20120204-Klopapierberg-2.jpg': '1',
+            '20120204-Klopapierberg-3.jpg': '2',
+        })
+        self.assertFalse(os.path.exists(self.journal))
+
+    def test_one_by_one(self):
+        images = [Image(os.path.join(self.album, name)) for name in sorted(os.listdir(self.album))]
+        listings = {}
+        for image in images:
+            image.number = '5'
+            image.rename(listings=listings)
+        self.assertEqual(self.contents(), {
+            '20120204-Klopapierberg-5.jpg': '0',
+            '20120204-Klopapierberg-6.jpg': '1',
+            '20120204-Klopapierberg-7.jpg': '2',
+        })
+        self.assertEqual(listings, {self.album: set(os.listdir(self.album))})
+
+    def test_one_by_one_without_listing(self):
+        images = [Image(os.path.join(self.album, name)) for name in sorted(os.listdir(self.album))]
+        stats.reset()
+        stats.enabled = True
+        try:
+            for image in images:
+                image.number = '5'
+                image.rename()
+            self.assertNotIn('directories listed', stats.counters)
+        finally:
+            stats.enabled = False
+            stats.reset()
+        self.assertEqual(self.contents(), {
+            '20120204-Klopapierberg-5.jpg': '0',
+            '20120204-Klopapierberg-6.jpg': '1',
+            '20120204-Klopapierberg-7.jpg': '2',
+        })
+
+    def test_cycle(self):
+        path = lambda number: os.path.join(self.album, '20120204-Klopapierberg-{}.jpg'.format(number))
+        rename_files([(path(0), path(1)), (path(1), path(2)), (path(2), path(0))])
+        self.assertEqual(self.contents(), {
+            '20120204-Klopapierberg-0.jpg': '2',
+            '20120204-Klopapierberg-1.jpg': '0',
+            '20120204-Klopapierberg-2.jpg': '1',
+        })
+
+    def test_stats(self):
+        path = lambda number: os.path.join(self.album, '20120204-Klopapierberg-{}.jpg'.format(number))
+        stats.reset()
+        stats.enabled = True
+        try:
+            rename_files([(path(2), path(3))], self.journal)
+            self.assertEqual(stats.counters['renames'], 1)
+            self.assertEqual(stats.counters['stat calls'], 2)
+            self.assertIn('rename', stats.timers)
+        finally:
+            stats.enabled = False
+            stats.reset()
+
+    def test_recover(self):
+        path = lambda number: os.path.join(self.album, '20120204-Klopapierberg-{}.jpg'.format(number))
+        steps = plan_rename_steps([(path(0), path(1)), (path(1), path(2)), (path(2), path(3))])
+        with open(self.journal, 'w') as f:
+            for src, dst in steps:
+                f.write('step\t{}\t{}\n'.format(src, dst))
+            f.write('planned\ndone\t0\n')
+        os.rename(*steps[0])
+        os.rename(*steps[1])
+
+        self.assertEqual(recover_renames(self.journal, rollback=True), 2)
+        self.assertEqual(sorted(self.contents().values()), ['0', '1', '2'])
+        self.assertEqual(self.contents()['20120204-Klopapierberg-0.jpg'], '0')
+        self.assertFalse(os.path.exists(self.journal))
+
+    def test_recover_unrecorded(self):
+        path = lambda number: os.path.join(self.album, '20120204-Klopapierberg-{}.jpg'.format(number))
+        steps = [(path(0), path(5)), (path(1), path(6)), (path(2), path(7))]
+        for rollback, expected in [(False, 1), (True, 2)]:
+            with open(self.journal, 'w') as f:
+                for src, dst in steps:
+                    f.write('step\t{}\t{}\n'.format(src, dst))
+                f.write('planned\n')
+            # Two steps happened, but none was recorded.
+            os.rename(*steps[0])
+            os.rename(*steps[1])
+
+            self.assertEqual(recover_renames(self.journal, rollback), expected)
+            if rollback:
+                self.assertEqual(self.contents(), {
+                    '20120204-Klopapierberg-0.jpg': '0',
+                    '20120204-Klopapierberg-1.jpg': '1',
+                    '20120204-Klopapierberg-2.jpg': '2',
+                })
+            else:
+                self.assertEqual(self.contents(), {
+                    '20120204-Klopapierberg-5.jpg': '0',
+                    '20120204-Klopapierberg-6.jpg': '1',
+                    '20120204-Klopapierberg-7.jpg': '2',
+                })
+                for src, dst in steps:
+                    os.rename(dst, src)
+
+    def test_recover_never_overwrites(self):
+        path = lambda number: os.path.join(self.album, '20120204-Klopapierberg-{}.jpg'.format(number))
+        with open(self.journal, 'w') as f:
+            f.write('step\t{}\t{}\nplanned\n'.format(path(0), path(1)))
+        with self.assertRaises(PictureDBError):
+            recover_renames(self.journal)
+        self.assertTrue(os.path.exists(self.journal))
+        self.assertEqual(self.contents()['20120204-Klopapierberg-1.jpg'], '1')
+
+    def test_unfinished_journals(self):
+        crashed = os.path.join(self.tempdir, 'rename-1.journal')
+        running = os.path.join(self.tempdir, 'rename-2.journal')
+        for journal in [crashed, running]:
+            with open(journal, 'w') as f:
+                f.write('planned\n')
+
+        with open(running) as f:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            self.assertEqual(unfinished_rename_journals(self.tempdir), [crashed])
+            with self.assertRaises(PictureDBError):
+                recover_renames(running)
+
+        self.assertEqual(recover_renames(crashed), 0)
+        self.assertEqual(unfinished_rename_journals(self.tempdir), [running])
+
+
+class PlanRenamesTest(unittest.TestCase):
+    def setUp(self):
+        self.listings = {'20120204-Klopapierberg': set([
+            '20120204-Klopapierberg-1.jpg',
+            '20120204-Klopapierberg-2.jpg',
+            'a.jpg',
+        ])}
+
+    def test_bump(self):
+        image = Image('20120204-Klopapierberg/a.jpg')
+        image.number = '1'
+        self.assertEqual(plan_renames([image], self.listings), [image])
+        self.assertEqual(image.number, '3')
+
+    def test_skip(self):
+        image = Image('20120204-Klopapierberg/a.jpg')
+        image.number = '1'
+        self.assertEqual(plan_renames([image], self.listings, 'skip'), [])
+
+    def test_fail(self):
+        image = Image('20120204-Klopapierberg/a.jpg')
+        image.number = '1'
+        with self.assertRaises(RenameCollisionError):
+            plan_renames([image], self.listings, 'fail')
+
+    def test_vacated(self):
+        first = Image('20120204-Klopapierberg/20120204-Klopapierberg-1.jpg')
+        second = Image('20120204-Klopapierberg/a.jpg')
+        compress_numbers([second, first])
+        self.assertEqual(plan_renames([second, first], self.listings), [second, first])
+        self.assertEqual((second.number, first.number), ('1', '3'))
+
+    def test_unchanged_keeps_name(self):
+        first = Image('20120204-Klopapierberg/a.jpg')
+        first.number = '2'
+        second = Image('20120204-Klopapierberg/20120204-Klopapierberg-2.jpg')
+        self.assertEqual(plan_renames([first, second], self.listings), [first])
+        self.assertEqual(first.number, '3')
+
+
+class TagTransactionTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.album = os.path.join(self.tempdir, '20120204-Klopapierberg')
+        os.mkdir(self.album)
+        for name in ['20120204-Klopapierberg-1#Foo.jpg', '20120204-Klopapierberg-2.jpg']:
+            open(os.path.join(self.album, name), 'w').close()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_net_delta(self):
+        first = os.path.join(self.album, '20120204-Klopapierberg-1#Foo.jpg')
+        second = os.path.join(self.album, '20120204-Klopapierberg-2.jpg')
+        transaction = TagTransaction()
+        transaction.add(first, Tag('Foo'))
+        transaction.add(second, Tag('Bar'))
+        transaction.remove(second, Tag('Bar'))
+        transaction.add(second, Tag('Baz'))
+        changed = transaction.apply(iptc=False)
+        self.assertEqual([image.origname for image in changed], [second])
+
+        batch_rename(changed)
+        self.assertEqual(sorted(os.listdir(self.album)), [
+            '20120204-Klopapierberg-1#Foo.jpg',
+            '20120204-Klopapierberg-2#Baz.jpg',
+        ])
+
+
+class PlanTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.album = os.path.join(self.tempdir, '20120204-Klopapierberg')
+        os.mkdir(self.album)
+        for number in [1, 3]:
+            with open(os.path.join(self.album, '20120204-Klopapierberg-{}.jpg'.format(number)), 'wb') as f:
+                f.write(minimal_jpeg)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def plan(self):
+        images = [Image(os.path.join(self.album, name)) for name in sorted(os.listdir(self.album))]
+        compress_numbers(images)
+        images[1].add_tag(Tag('Grünkohl'))
+        renamed = plan_renames(images)
+        return make_plan(renamed, [images[1]])
+
+    def test_apply(self):
+        plan = os.path.join(self.tempdir, 'plan')
+        with open(plan, 'w') as f:
+            write_plan(self.plan(), f)
+        with open(plan) as f:
+            entries = read_plan(f)
+        self.assertEqual(entries[0]['keywords'], ['Grünkohl'])
+        self.assertIsInstance(entries[1]['src'], str)
+
+        apply_plan(entries)
+        self.assertEqual(sorted(os.listdir(self.album)), [
+            '20120204-Klopapierberg-1.jpg',
+            '20120204-Klopapierberg-2#Grünkohl.jpg',
+        ])
+        self.assertEqual(read_iptc_keywords(os.path.join(self.album, '20120204-Klopapierberg-2#Grünkohl.jpg')), ['Grünkohl'])
+
+    def test_other_directory(self):
+        cwd = os.getcwd()
+        os.chdir(self.tempdir)
+        try:
+            self.album = '20120204-Klopapierberg'
+            entries = self.plan()
+        finally:
+            os.chdir(cwd)
+        self.album = os.path.join(self.tempdir, self.album)
+
+        apply_plan(entries)
+        self.assertEqual(sorted(os.listdir(self.album)), [
+            '20120204-Klopapierberg-1.jpg',
+            '20120204-Klopapierberg-2#Grünkohl.jpg',
+        ])
+
+    def test_stale(self):
+        entries = self.plan()
+        os.remove(os.path.join(self.album, '20120204-Klopapierberg-3.jpg'))
+        with self.assertRaises(PictureDBError):
+            apply_plan(entries)
+
+    def test_invalid(self):
+        with self.assertRaises(PictureDBError):
+            read_plan(['{"action": "delete", "path": "a.jpg"}\n'])
+
+    def test_iter_plan(self):
+        plan = tempfile.TemporaryFile()
+        write_plan(self.plan(), plan)
+        plan.write('{"action": "rename", "src": "a.jpg"}\n')
+        plan.seek(0)
+
+        # The valid entries come before the error.
+        entries = iter_plan(plan)
+        self.assertEqual([next(entries), next(entries)], self.plan())
+        with self.assertRaises(PictureDBError):
+            next(entries)
+
+    def test_albums(self):
+        other = os.path.join(self.tempdir, '20120205-Grünkohl')
+        os.mkdir(other)
+        with open(os.path.join(other, '1.jpg'), 'wb') as f:
+            f.write(minimal_jpeg)
+
+        # Like ``hashtag --confirm global``, the plan is spooled album by
+        # album and applied album by album.
+        plan = tempfile.TemporaryFile()
+        write_plan(self.plan(), plan)
+        write_plan(make_plan([Image(os.path.join(other, '1.jpg'))], []), plan)
+        plan.seek(0)
+
+        directories = []
+        for directory, entries in iter_plan_albums(plan):
+            directories.append(directory)
+            apply_plan(entries)
+        self.assertEqual(directories, [self.album, other])
+        self.assertEqual(sorted(os.listdir(self.album)), [
+            '20120204-Klopapierberg-1.jpg',
+            '20120204-Klopapierberg-2#Grünkohl.jpg',
+        ])
+        self.assertEqual(os.listdir(other), ['20120205-Grünkohl-1.jpg'])
+
+
+class HashtagTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.album = os.path.join(self.tempdir, '20120204-Klopapierberg')
+        os.mkdir(self.album)
+        for name in ['a.jpg', 'b.jpg']:
+            open(os.path.join(self.album, name), 'w').close()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def hashtag(self, arguments, answer):
+        """
+        Runs ``hashtag`` with its caches in the temporary directory.
+
+        :return: Standard output and standard error.
+        :rtype: tuple
+        """
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'hashtag')
+        process = subprocess.Popen([sys.executable, script] + arguments,
+                                   stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE,
+                                   env=dict(os.environ, HOME=self.tempdir))
+        return process.communicate(answer)
+
+    def test_jsonl(self):
+        out, err = self.hashtag(['--output', 'jsonl', self.album, '-a', 'Foo'], 'n\n')
+        rows = [json.loads(line) for line in out.splitlines()]
+        self.assertEqual([row['old'] for row in rows], ['a.jpg', 'b.jpg'])
+        self.assertIn('Rename files?', err)
+        self.assertEqual(sorted(os.listdir(self.album)), ['a.jpg', 'b.jpg'])
+
+    def test_columns_global(self):
+        out, err = self.hashtag(['--output', 'columns', '--confirm', 'global', self.album, '-a', 'Foo'], 'y\n')
+        self.assertEqual([line.split('\t') for line in out.splitlines()], [
+            [self.album, 'a.jpg', '20120204-Klopapierberg-1#Foo.jpg'],
+            [self.album, 'b.jpg', '20120204-Klopapierberg-2#Foo.jpg'],
+        ])
+        self.assertEqual(sorted(os.listdir(self.album)), [
+            '20120204-Klopapierberg-1#Foo.jpg',
+            '20120204-Klopapierberg-2#Foo.jpg',
+        ])
+
+
+class WatchTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.album = os.path.join(self.tempdir, '20120204-Klopapierberg')
+        os.mkdir(self.album)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_sync_files(self):
+        path = os.path.join(self.album, 'IMG_0001.jpg')
+        with open(path, 'wb') as f:
+            f.write(minimal_jpeg)
+        write_iptc_keywords(path, ['Foo'])
+
+        changed = sync_files([path, os.path.join(self.album, 'gone.jpg')], iptc=True)
+        self.assertEqual(len(changed), 1)
+        self.assertEqual(os.listdir(self.album), ['20120204-Klopapierberg-0001#Foo.jpg'])
+
+    def test_watcher(self):
+        try:
+            watcher = Watcher(self.tempdir, delay=0.05)
+        except PictureDBError:
+            self.skipTest('inotify is not available')
+
+        try:
+            album = os.path.join(self.tempdir, '20120205-Grünkohl')
+            os.mkdir(album)
+            with open(os.path.join(self.album, 'a.jpg'), 'w') as f:
+                f.write('a')
+            with open(os.path.join(self.album, '.a.jpg.tmp'), 'w') as f:
+                f.write('a')
+            self.assertEqual(next(watcher.batches()), [os.path.join(self.album, 'a.jpg')])
+
+            with open(os.path.join(album, 'b.jpg'), 'w') as f:
+                f.write('b')
+            self.assertEqual(next(watcher.batches()), [os.path.join(album, 'b.jpg')])
+        finally:
+            watcher.close()
+
+
+class DedupTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.files = {}
+        big = b'x' * (3 * dedup_chunk_size)
+        contents = {
+            '20120204-Klopapierberg/20120204-Klopapierberg-1#Foo.jpg': big,
+            '20120204-Klopapierberg/20120204-Klopapierberg-2.jpg': big[:-1] + b'y',
+            '20120204-Klopapierberg/20120204-Klopapierberg-3.jpg': big[:100] + b'y' + big[101:],
+            '20120205-Grünkohl/20120205-Grünkohl-1#Bar.jpg': big,
+            '20120205-Grünkohl/20120205-Grünkohl-2.jpg': b'small',
+        }
+        for name, data in contents.items():
+            path = os.path.join(self.tempdir, name)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'wb') as f:
+                f.write(data)
+            self.files[name] = path
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_find(self):
+        expected = [[
+            self.files['20120204-Klopapierberg/20120204-Klopapierberg-1#Foo.jpg'],
+            self.files['20120205-Grünkohl/20120205-Grünkohl-1#Bar.jpg'],
+        ]]
+        cache = HashCache(os.path.join(self.tempdir, 'hashes.sqlite'))
+        self.assertEqual(find_duplicates([self.tempdir], jobs=2, cache=cache), expected)
+
+        path = expected[0][0]
+        signature = MetadataIndex._signature(path)
+        self.assertIsNotNone(cache.lookup(signature, 'full'))
+        cache.store(signature, 'full', 'cached')
+        self.assertEqual(find_duplicates([self.tempdir], cache=cache), [])
+        cache.close()
+
+    def test_merge(self):
+        changed = merge_duplicate_tags(find_duplicates([self.tempdir]))
+        self.assertEqual(len(changed), 2)
+        batch_rename(changed)
+        self.assertTrue(os.path.exists(os.path.join(self.tempdir, '20120205-Grünkohl/20120205-Grünkohl-1#Bar#Foo.jpg')))
+        self.assertTrue(os.path.exists(os.path.join(self.tempdir, '20120204-Klopapierberg/20120204-Klopapierberg-1#Bar#Foo.jpg')))
+
+    def test_merge_unparseable(self):
+        unparseable = os.path.join(self.tempdir, 'Unsortiert', 'a.jpg')
+        os.makedirs(os.path.dirname(unparseable))
+        shutil.copy(self.files['20120205-Grünkohl/20120205-Grünkohl-2.jpg'], unparseable)
+        groups = find_duplicates([self.tempdir])
+        self.assertEqual(len(groups), 2)
+        self.assertEqual(len(merge_duplicate_tags(groups)), 2)
+
+
+class ThumbnailTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.paths = []
+        for number in range(3):
+            path = os.path.join(self.tempdir, '{}.jpg'.format(number))
+            with open(path, 'wb') as f:
+                f.write(exif_jpeg(minimal_jpeg + str(number)))
+            self.paths.append(path)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_read(self):
+        self.assertEqual(read_exif_thumbnail(self.paths[0]), minimal_jpeg + '0')
+        with open(self.paths[0], 'wb') as f:
+            f.write(minimal_jpeg)
+        self.assertIsNone(read_exif_thumbnail(self.paths[0]))
+
+    def test_cache(self):
+        directory = os.path.join(self.tempdir, 'cache')
+        cache = ThumbnailCache(directory, max_size=2 * 4096)
+        for path in self.paths:
+            cache.get(path)
+        self.assertEqual(len(os.listdir(directory)), 2)
+
+        cache = ThumbnailCache(directory, max_size=2 * 4096)
+        self.assertEqual(cache.get(self.paths[2]), minimal_jpeg + '2')
+        self.assertEqual(len(cache.entries), 2)
+
+
+class ExifDateTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.album = os.path.join(self.tempdir, '20120225-Event')
+        os.mkdir(self.album)
+        self.path = os.path.join(self.album, '20120224-Event-001.jpg')
+        with open(self.path, 'wb') as f:
+            f.write(exif_jpeg(date='2012:02:23 18:30:00'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_read(self):
+        self.assertEqual(read_exif_date(self.path), '20120223')
+        with open(self.path, 'wb') as f:
+            f.write(exif_jpeg())
+        self.assertIsNone(read_exif_date(self.path))
+
+    def test_sources(self):
+        self.assertEqual(Image(self.path).date, '20120225')
+        self.assertEqual(Image(self.path, date_source='filename').date, '20120224')
+        self.assertEqual(Image(self.path, date_source='exif').date, '20120223')
+
+    def test_bogus_prefix(self):
+        path = os.path.join(self.album, '20121339-Event-002.jpg')
+        shutil.copy(self.path, path)
+        self.assertEqual(Image(path, date_source='filename').date, '20120225')
+
+    def test_camera_name(self):
+        os.mkdir(os.path.join(self.tempdir, 'Urlaub'))
+        path = os.path.join(self.tempdir, 'Urlaub', 'IMG_3523.jpg')
+        shutil.copy(self.path, path)
+        with self.assertRaises(FolderParseError):
+            Image(path)
+        self.assertEqual(os.path.basename(Image(path, date_source='exif').current_path()), '20120223-Urlaub-3523.jpg')
+
+
+class ServiceTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.album = os.path.join(self.tempdir, '20120204-Klopapierberg')
+        os.mkdir(self.album)
+        self.path = os.path.join(self.album, '20120204-Klopapierberg-1.jpg')
+        with open(self.path, 'wb') as f:
+            f.write(minimal_jpeg)
+
+        # Where ``hashtag --client`` looks with the home in the temporary
+        # directory.
+        cache = os.path.join(self.tempdir, '.cache', 'picture-db-scripts')
+        os.makedirs(cache)
+        self.socket = os.path.join(cache, 'service.socket')
+        self.service = PictureService(self.socket, tag_index=os.path.join(self.tempdir, 'tags.index'))
+        self.service.journal = os.path.join(self.tempdir, 'rename.journal')
+        self.thread = threading.Thread(target=self.service.serve)
+        self.thread.start()
+        while not os.path.exists(self.socket):
+            self.thread.join(0.01)
+
+    def tearDown(self):
+        request_service({'command': 'shutdown'}, self.socket)
+        self.thread.join()
+        shutil.rmtree(self.tempdir)
+
+    def test_tag(self):
+        response = request_service({'command': 'tag', 'paths': [self.album], 'add': ['Grünkohl'], 'iptc': True}, self.socket)
+        newname = os.path.join(self.album, '20120204-Klopapierberg-1#Grünkohl.jpg')
+        self.assertEqual(response['changed'], [[self.path, newname]])
+        self.assertEqual(read_iptc_keywords(newname), ['Grünkohl'])
+        self.assertIn('Grünkohl', request_service({'command': 'tags'}, self.socket)['tags'])
+
+        # The image is kept and not parsed again.
+        image = self.service.images[newname][0]
+        request_service({'command': 'tag', 'paths': [newname], 'remove': ['Grünkohl']}, self.socket)
+        self.assertEqual(image.origname, self.path)
+
+    def test_skipped(self):
+        taken = os.path.join(self.album, '20120204-Klopapierberg-1#Foo.jpg')
+        open(taken, 'w').close()
+        response = request_service({'command': 'tag', 'paths': [self.path], 'add': ['Foo'], 'collision': 'skip'}, self.socket)
+        self.assertEqual(response['changed'], [])
+        self.assertNotIn(self.path, self.service.images)
+
+        # The next request starts from the file, which has no tags.
+        response = request_service({'command': 'tag', 'paths': [self.path]}, self.socket)
+        self.assertEqual(response['changed'], [])
+        self.assertEqual(self.service.images[self.path][0].tags, set())
+
+    def test_silent_client(self):
+        self.service.timeout = 0.1
+        silent = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        silent.connect(self.socket)
+        try:
+            self.assertIn('images', request_service({'command': 'ping'}, self.socket, 5))
+        finally:
+            silent.close()
+
+    def test_client(self):
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'hashtag')
+        process = subprocess.Popen([sys.executable, script, '--client', self.path, '-a', 'Grünkohl'],
+                                   stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                   env=dict(os.environ, HOME=self.tempdir))
+        out, err = process.communicate()
+        self.assertEqual(process.returncode, 0, err)
+        self.assertEqual(out, '{} → 20120204-Klopapierberg-1#Grünkohl.jpg\n'.format(self.path))
+        self.assertEqual(os.listdir(self.album), ['20120204-Klopapierberg-1#Grünkohl.jpg'])
+
+    def test_permissions(self):
+        self.assertEqual(os.stat(self.socket).st_mode & 0o077, 0)
+
+    def test_errors(self):
+        with self.assertRaises(PictureDBError):
+            request_service({'command': 'delete'}, self.socket)
+        with self.assertRaises(ServiceError):
+            request_service({'command': 'ping'}, os.path.join(self.tempdir, 'missing'))
+
+
+class WriteIPTCTest(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tempdir, 'a.jpg')
+        with open(self.path, 'wb') as f:
+            f.write(minimal_jpeg)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_in_place(self):
+        self.assertFalse(write_iptc_keywords(self.path, ['Foo', 'Bar']))
+        size = os.path.getsize(self.path)
+        self.assertEqual(IPTCInfo(self.path).keywords, ['Foo', 'Bar'])
+
+        self.assertTrue(write_iptc_keywords(self.path, ['Martin Ueding']))
+        self.assertEqual(os.path.getsize(self.path), size)
+        self.assertEqual(IPTCInfo(self.path).keywords, ['Martin Ueding'])
+
+        self.assertFalse(write_iptc_keywords(self.path, ['X' * 1000]))
+        self.assertEqual(IPTCInfo(self.path).keywords, ['X' * 1000])
+        with open(self.path, 'rb') as f:
+            self.assertTrue(f.read().endswith(minimal_jpeg[20:]))
+
+    def test_not_jpeg(self):
+        with open(self.path, 'wb') as f:
+            f.write(b'GIF89a')
+        with self.assertRaises(JPEGFormatError):
+            write_iptc_keywords(self.path, ['Foo'])
+        with self.assertRaises(JPEGFormatError):
+            read_iptc_keywords(self.path)
+
+    def test_read(self):
+        self.assertEqual(read_iptc_keywords(self.path), [])
+        iptc = IPTCInfo(self.path, force=True)
+        iptc.data['keywords'] = ['Foo', 'Bar']
+        iptc.data['caption/abstract'] = 'Caption'
+        iptc.save()
+        self.assertEqual(read_iptc_keywords(self.path), ['Foo', 'Bar'])
+
+    def test_image(self):
+        album = os.path.join(self.tempdir, '20120204-Klopapierberg')
+        os.mkdir(album)
+        path = os.path.join(album, '20120204-Klopapierberg-1#Foo.jpg')
+        os.rename(self.path, path)
+        write_iptc_keywords(path, ['Bar'])
+
+        image = Image(path)
+        self.assertEqual(sorted(image.get_tags(iptc=True)), [Tag('Bar'), Tag('Foo')])
+
+        image.save()
+        path = os.path.join(album, '20120204-Klopapierberg-1#Bar#Foo.jpg')
+        self.assertEqual(read_iptc_keywords(path), ['Bar', 'Foo'])
@@ -15,7 +15,11 @@ setup(
     scripts = [
         "hashtag",
         "pdb-batch-rename",
+        "pdb-dedup",
+        "pdb-query",
+        "pdb-service",
         "pdb-symlink",
+        "pdb-watch",
     ],
     version = "2.2",
     install_requires=[